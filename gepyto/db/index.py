@@ -18,16 +18,46 @@ try:
 except ImportError:
     import pickle
 
-import bisect
+import collections
+import heapq
 import logging
 import re
 import os
+import json
+import io
+import mmap
+import struct
+import zlib
 import functools
+import tempfile
+import threading
+import multiprocessing
 
 import numpy as np
 
+from ..formats import bgzf
 
-MAGIC_NUMBER = 10 ** 9  # This should be larger than any indexed position.
+
+# Indices created by gepyto < 0.9.3 encoded loci as
+# chrom_code * MAGIC_NUMBER + pos.
+MAGIC_NUMBER = 10 ** 9
+
+# Binary index format: magic string, format version, length of the JSON
+# metadata block and offset of the (memory mappable) arrays.
+INDEX_MAGIC = b"\x89GTIDX"
+INDEX_FORMAT_VERSION = 2
+INDEX_HEADER = struct.Struct("<6sHQQ")
+INDEX_ALIGNMENT = 64
+
+# Below this number of bytes, the lines are searched linearly instead of being
+# bisected.
+_BISECT_MIN_BYTES = 1024
+
+# The order of the non-numeric chromosomes (for sort_and_index).
+_CHROM_ORDER = {"X": 0, "Y": 1, "XY": 2, "M": 3, "MT": 3}
+
+# The maximal total size of the indices kept in memory by get_index.
+INDEX_CACHE_MAX_BYTES = 512 * 1024 ** 2
 
 
 class EndOfFile(Exception):
@@ -52,8 +82,16 @@ def _get_locus(line, chrom_col, pos_col, delimiter):
     return chrom, pos
 
 
+def _normalize_chrom(chrom):
+    chrom = str(chrom)
+    if chrom.startswith("chr"):
+        chrom = chrom[3:]
+    return chrom
+
+
 def build_index(fn, chrom_col, pos_col, delimiter='\t', skip_lines=0,
-                index_rate=0.2, ignore_startswith=None):
+                index_rate=0.2, ignore_startswith=None, processes=1,
+                bloom=False, bloom_fp_rate=0.01):
     """Build a index for the given file.
 
     :param fn: The filename
@@ -81,317 +119,2548 @@ def build_index(fn, chrom_col, pos_col, delimiter='\t', skip_lines=0,
                               be used to parse the rest of the file.
     :type ignore_startswith: str
 
+    :param processes: The number of worker processes. If larger than one, the
+                      file is split into byte ranges (aligned on lines) that
+                      are indexed in parallel and then merged.
+    :type processes: int
+
+    :param bloom: Also build a Bloom filter of all the loci of the file, so
+                  that lookups of absent loci don't need to read the file. The
+                  whole file is read to build it, even in sparse mode.
+    :type bloom: bool
+
+    :param bloom_fp_rate: The target false positive rate of the Bloom filter.
+    :type bloom_fp_rate: float
+
     :returns: The index filename.
     :rtype: str
 
+    BGZF compressed files can be indexed directly. In that case, the index
+    contains virtual offsets and the file has to be opened using
+    :py:func:`open_file` (or :py:class:`gepyto.formats.bgzf.BgzfFile`) before
+    using :py:func:`goto`.
+
     """
 
     assert chrom_col != pos_col
+    assert processes >= 1
 
     idx_fn = _get_index_fn(fn)
 
     size = os.path.getsize(fn)  # Total filesize
     start = 0  # Byte position of the meat of the file (data).
-    with open(fn, "r") as f:
-        if skip_lines > 0:
-            for i in range(skip_lines):
-                # Skip header lines if needed.
-                f.readline()
 
-        current_position = f.tell()
-        # Skip the lines that start with the user provided string.
-        if ignore_startswith is not None:
-            line = f.readline()
-            while line.startswith(ignore_startswith):
-                current_position = f.tell()
-                line = f.readline()
-            f.seek(current_position)
+    # Bind some parameters so that function calls look nicer.
+    get_locus = functools.partial(
+        _get_locus,
+        chrom_col=chrom_col,
+        pos_col=pos_col,
+        delimiter=delimiter
+    )
 
+    with open_file(fn) as f:
+        is_bgzf = isinstance(f, bgzf.BgzfFile)
+
+        _skip_header(f, skip_lines, ignore_startswith)
         start = f.tell()
+        raw_start = _raw_offset(f, start)
+        end = _eof_tell(f, size)
 
-        size -= start  # Adjust file size to remove header.
+        size -= raw_start  # Adjust file size to remove header.
 
         # Estimate the line length using first 100 lines
-        line_length = np.empty((100))
-        prev = start
+        line_length = np.zeros((100))
         # We take 100 sample positions in the file.
         for i, jump in enumerate(np.linspace(0, 0.9 * size, 100)):
-            f.seek(start + int(jump))
+            _seek_raw(f, raw_start + int(jump))
             f.readline()  # Throw away chunk.
-            line_start = f.tell()
-            f.readline()
-            line_length[i] = f.tell() - line_start
-
-        line_length = np.mean(line_length)
-        approx_num_lines = size / line_length
+            line_length[i] = len(f.readline())
 
-        # Go back to start
-        f.seek(start)
+        if np.any(line_length > 0):
+            line_length = np.mean(line_length[line_length > 0])
+        else:
+            line_length = 1
 
-        # Prepare the variables to keep track of the position encoding.
-        encoding = {
-            "current_key": 0,
-            "chromosomes": {}
-        }
-        index = []  # List of (code, seek) tuples.
-
-        def encode_locus(chrom, pos):
-            chrom = str(chrom)
-            if chrom not in encoding["chromosomes"]:
-                encoding["current_key"] += 1
-                encoding["chromosomes"][chrom] = encoding["current_key"]
-
-            return encoding["chromosomes"][chrom] * MAGIC_NUMBER + pos
-
-        # Bind some parameters so that function calls look nicer.
-        get_locus = functools.partial(
-            _get_locus,
-            chrom_col=chrom_col,
-            pos_col=pos_col,
-            delimiter=delimiter
-        )
+        if is_bgzf:
+            # Use the number of compressed bytes per line.
+            line_length *= f.compression_ratio
 
-        # Add the first line to the index.
-        chrom1, pos1 = get_locus(f.readline())
-        index.append((encode_locus(chrom1, pos1), start))
+        approx_num_lines = size / line_length
 
         # Compute the seek jump size.
         target_num_lines = index_rate * approx_num_lines
         seek_jump = size / target_num_lines
 
-        # We start indexing here.
-        current_position = f.tell()
+        # Split the file in byte ranges. The boundaries are moved to the first
+        # line of a new locus so that every range starts with a line that
+        # can be indexed.
+        boundaries = [start]
+        for jump in np.linspace(0, size, processes + 1)[1:-1]:
+            _seek_raw(f, raw_start + int(jump))
+            f.readline()  # Throw away partial line.
+            try:
+                locus = get_locus(f.readline())
+                tell = f.tell()
+                while get_locus(f.readline()) == locus:
+                    tell = f.tell()
+            except EndOfFile:
+                break
+
+            if tell > boundaries[-1]:
+                boundaries.append(tell)
+        boundaries.append(end)
+
+    if index_rate == 1:
+        logging.debug("Full indexing mode.")
+        seek_jump = None
+    else:
+        logging.debug("Sparse indexing mode.")
+
+    bloom_filter = None
+    if bloom:
+        bloom_filter = _BloomFilter.for_capacity(approx_num_lines,
+                                                 bloom_fp_rate)
+        bloom = (bloom_filter.n_bits, bloom_filter.n_hashes)
+    else:
+        bloom = None
+
+    chunks = [
+        (fn, boundaries[i], boundaries[i + 1], chrom_col, pos_col, delimiter,
+         seek_jump, bloom)
+        for i in range(len(boundaries) - 1)
+    ]
+
+    if len(chunks) == 1:
+        results = [_index_chunk(chunks[0])]
+    else:
+        logging.debug("Indexing {} chunks using {} processes.".format(
+            len(chunks), processes
+        ))
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_index_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    # Merge the chunks, making sure that the file is sorted across the
+    # boundaries.
+    contigs = []
+    contig_starts = []
+    positions = []
+    offsets = []
+    for chunk_index, bits in results:
+        _merge_chunk(chunk_index, contigs, contig_starts, positions, offsets)
+        if bits is not None:
+            bloom_filter.bits |= bits
 
-        if index_rate == 1:
-            logging.debug("Full indexing mode.")
-            tell = f.tell()
+    # Create a dict containing the relevant information to be able to find the
+    # chromosome and position columns. We also keep what is needed to update
+    # the index if the file grows.
+    info = {"chrom_col": chrom_col, "pos_col": pos_col, "delimiter": delimiter,
+            "compression": "bgzf" if is_bgzf else None,
+            "data_size": size + raw_start, "seek_jump": seek_jump,
+            "record_size": float(line_length)}
+
+    _write_contig_index(idx_fn, info, contigs, contig_starts, positions,
+                        offsets, bloom_filter)
+
+    return idx_fn
+
+
+def update_index(fn):
+    """Update the index of a file that grew since it was indexed.
+
+    :param fn: The filename of the indexed file.
+    :type fn: str
+
+    :returns: The index filename.
+    :rtype: str
+
+    This is meant for append-only files: only the new lines are indexed, and
+    they have to be sorted after the lines that were already in the file.
+    The index has to be built again (using :py:func:`build_index`) if the
+    file was modified otherwise.
+
+    """
+    idx_fn = _get_index_fn(fn)
+    index = get_index(fn)
+    info = dict(index.info)
+
+    if "data_size" not in info:
+        raise Exception("This index can't be updated (it was created using "
+                        "an older version of gepyto).")
+
+    size = os.path.getsize(fn)
+    if size == info["data_size"]:
+        logging.debug("File '{}' didn't change.".format(fn))
+        return idx_fn
+
+    if size < info["data_size"]:
+        raise Exception("File '{}' is smaller than when it was indexed (use "
+                        "build_index).".format(fn))
+
+    get_locus = functools.partial(
+        _get_locus,
+        chrom_col=info["chrom_col"],
+        pos_col=info["pos_col"],
+        delimiter=info["delimiter"],
+    )
+
+    # We index from the last indexed locus, to correctly handle loci that
+    # span the old end of the file.
+    last_chrom = info["contigs"][-1]
+    last_pos = int(index.positions[-1])
+    last_offset = int(index.offsets[-1])
+
+    with open_file(fn) as f:
+        f.seek(last_offset)
+        if get_locus(f.readline()) != (last_chrom, last_pos):
+            raise Exception("File '{}' was modified, not appended to (use "
+                            "build_index).".format(fn))
+
+        end = _eof_tell(f, size)
+
+    bloom_filter = None
+    if index.bloom is not None:
+        bloom_filter = _BloomFilter(index.bloom.n_bits, index.bloom.n_hashes,
+                                    np.array(index.bloom.bits))
+
+    logging.debug("Indexing the tail of '{}'.".format(fn))
+    tail_index, bits = _index_chunk((
+        fn, last_offset, end, info["chrom_col"], info["pos_col"],
+        info["delimiter"], info["seek_jump"],
+        None if bloom_filter is None else (bloom_filter.n_bits,
+                                           bloom_filter.n_hashes)
+    ))
+    if bits is not None:
+        bloom_filter.bits |= bits
+
+    contigs = list(info["contigs"])
+    contig_starts = [int(i) for i in index.contig_starts[:-1]]
+    positions = [int(i) for i in index.positions]
+    offsets = [int(i) for i in index.offsets]
+
+    # The first locus of the tail is the last indexed locus.
+    _merge_chunk(tail_index[1:], contigs, contig_starts, positions, offsets)
+
+    info["data_size"] = size
+    _write_contig_index(idx_fn, info, contigs, contig_starts, positions,
+                        offsets, bloom_filter)
+
+    return idx_fn
+
+
+def _skip_header(f, skip_lines, ignore_startswith):
+    """Moves the cursor to the first line of data."""
+    if skip_lines > 0:
+        for i in range(skip_lines):
+            # Skip header lines if needed.
+            f.readline()
+
+    current_position = f.tell()
+    # Skip the lines that start with the user provided string.
+    if ignore_startswith is not None:
+        line = f.readline()
+        while line.startswith(ignore_startswith):
+            current_position = f.tell()
             line = f.readline()
-            while line:
-                chrom, pos = get_locus(line)
-                code = encode_locus(chrom, pos)
+        f.seek(current_position)
+
+
+def _merge_chunk(chunk_index, contigs, contig_starts, positions, offsets):
+    """Appends the ``(chrom, pos, tell)`` of a chunk to the index lists, making
+    sure that the loci are sorted.
+
+    """
+    for chrom, pos, tell in chunk_index:
+        if not contigs or chrom != contigs[-1]:
+            if chrom in contigs:
+                raise Exception("This file is not sorted.")
+            contigs.append(chrom)
+            contig_starts.append(len(positions))
+
+        elif positions[-1] >= pos:
+            raise Exception("This file is not sorted.")
+
+        positions.append(pos)
+        offsets.append(tell)
+
+
+def _write_contig_index(fn, info, contigs, contig_starts, positions,
+                        offsets, bloom_filter=None):
+    """Writes the index from the lists built by :py:func:`_merge_chunk`."""
+    info = dict(info)
+    info["contigs"] = contigs
+    info["chrom_codes"] = dict((chrom, i) for i, chrom in enumerate(contigs))
+
+    arrays = {
+        "positions": np.array(positions, dtype=_positions_dtype(positions)),
+        "offsets": np.array(offsets, dtype=np.int64),
+        "contig_starts": np.array(contig_starts + [len(positions)],
+                                  dtype=np.int64),
+    }
+
+    info.pop("bloom", None)
+    if bloom_filter is not None:
+        info["bloom"] = {"n_bits": bloom_filter.n_bits,
+                         "n_hashes": bloom_filter.n_hashes}
+        arrays["bloom"] = bloom_filter.bits
+
+    _write_index(fn, info, arrays)
+
+
+class _BloomFilter(object):
+    """A Bloom filter of loci.
+
+    :param n_bits: The number of bits.
+    :type n_bits: int
+
+    :param n_hashes: The number of hash functions.
+    :type n_hashes: int
+
+    :param bits: The (packed) bits of the filter (a new filter is created if
+                 it is ``None``).
+    :type bits: :py:class:`numpy.ndarray`
+
+    The hashes are computed from the CRC32 of the chromosome and the position
+    (mixed using the SplitMix64 finalizer) and they are combined using double
+    hashing, so they are the same in every process.
+
+    """
+    def __init__(self, n_bits, n_hashes, bits=None):
+        self.n_bits = int(n_bits)
+        self.n_hashes = int(n_hashes)
+        if bits is None:
+            bits = np.zeros((self.n_bits + 7) // 8, dtype=np.uint8)
+        self.bits = bits
+        self._chrom_hashes = {}
+
+    @classmethod
+    def for_capacity(cls, n, fp_rate):
+        """Creates an empty filter for ``n`` loci."""
+        n = max(int(n), 1)
+        n_bits = max(int(np.ceil(-n * np.log(fp_rate) / np.log(2) ** 2)), 64)
+        n_hashes = max(int(round(n_bits / float(n) * np.log(2))), 1)
+        return cls(n_bits, n_hashes)
+
+    def _bit_indices(self, chroms, positions):
+        """Returns the bits (``n_hashes x n``) for the loci."""
+        chrom_hashes = []
+        for chrom in chroms:
+            h = self._chrom_hashes.get(chrom)
+            if h is None:
+                h = zlib.crc32(chrom.encode("utf-8")) & 0xffffffff
+                self._chrom_hashes[chrom] = h
+            chrom_hashes.append(h)
+
+        keys = np.array(chrom_hashes, dtype=np.uint64) << np.uint64(32)
+        keys ^= np.array(positions, dtype=np.uint64)
+
+        h1 = _splitmix64(keys)
+        h2 = _splitmix64(h1) | np.uint64(1)
+
+        n_bits = np.uint64(self.n_bits)
+        return np.array([
+            (h1 + np.uint64(i) * h2) % n_bits for i in range(self.n_hashes)
+        ])
+
+    def add(self, chroms, positions):
+        """Adds loci to the filter."""
+        bits = self._bit_indices(chroms, positions).ravel()
+        np.bitwise_or.at(
+            self.bits, (bits >> np.uint64(3)).astype(np.intp),
+            (np.uint8(1) << (bits & np.uint64(7)).astype(np.uint8))
+        )
+
+    def contains(self, chroms, positions):
+        """Checks if loci might be in the filter.
+
+        :returns: A boolean array, False if a locus is definitely absent.
+        :rtype: :py:class:`numpy.ndarray`
+
+        """
+        bits = self._bit_indices(chroms, positions)
+        is_set = (self.bits[(bits >> np.uint64(3)).astype(np.intp)] >>
+                  (bits & np.uint64(7)).astype(np.uint8)) & 1
+        return np.all(is_set == 1, axis=0)
+
+
+def _splitmix64(x):
+    """The SplitMix64 finalizer (for arrays of uint64)."""
+    x = x + np.uint64(0x9e3779b97f4a7c15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
 
-                if index[-1][0] > code:
-                    raise Exception("This file is not sorted.")
-                elif index[-1][0] == code:
-                    pass
-                else:
-                    index.append((code, tell))
+def _positions_dtype(positions):
+    """Use 32 bits for the positions, unless there is a very long contig."""
+    if len(positions) > 0 and np.max(positions) >= 2 ** 32:
+        return np.int64
+    return np.uint32
 
+
+def _index_chunk(args):
+    """Index the lines starting in the ``[start, end)`` byte range of a file.
+
+    This is the unit of work for :py:func:`build_index`. It is a module level
+    function so that it can be sent to worker processes. The ``start`` of the
+    range has to be the start of the first line of a locus.
+
+    The ``seek_jump`` is the number of (compressed) bytes to skip between
+    indexed lines, or ``None`` to index every locus. In sparse mode, the first
+    line of every contig is also indexed (so that all the contigs of the file
+    are in the index).
+
+    If ``bloom`` (a tuple of the number of bits and of hash functions) is not
+    ``None``, every line of the range is read to fill a Bloom filter.
+
+    :returns: A list of ``(chrom, pos, tell)`` tuples and the bits of the
+              Bloom filter (or ``None``).
+    :rtype: tuple
+
+    """
+    fn, start, end, chrom_col, pos_col, delimiter, seek_jump, bloom = args
+
+    get_locus = functools.partial(
+        _get_locus,
+        chrom_col=chrom_col,
+        pos_col=pos_col,
+        delimiter=delimiter
+    )
+
+    index = []
+
+    def add_locus(chrom, pos, tell):
+        if index:
+            prev_chrom, prev_pos, _ = index[-1]
+            if prev_chrom == chrom and prev_pos > pos:
+                raise Exception("This file is not sorted.")
+        index.append((chrom, pos, tell))
+
+    with open_file(fn) as f:
+        def add_contig_starts(start, stop):
+            # Index the first line of the contigs starting in the lines of the
+            # [start, stop) range (they would be skipped otherwise).
+            f.seek(start)
+            prev_chrom = index[-1][0]
+            tell = start
+            line = f.readline()
+            while line and tell < stop:
+                chrom, pos = get_locus(line)
+                if chrom != prev_chrom:
+                    add_locus(chrom, pos, tell)
+                    prev_chrom = chrom
                 tell = f.tell()
                 line = f.readline()
 
-        else:
-            logging.debug("Sparse indexing mode.")
-            while current_position + seek_jump < size + start:
-                # Jump in the file.
-                f.seek(current_position + seek_jump)
-                # Throw away partial line.
-                f.readline()
+        # Add the first line to the index.
+        f.seek(start)
+        chrom, pos = get_locus(f.readline())
+        add_locus(chrom, pos, start)
+
+        if seek_jump is None or bloom is not None:
+            return _index_chunk_scan(f, index, add_locus, get_locus, end,
+                                     seek_jump, bloom)
+
+        # We start indexing here.
+        current_position = f.tell()
+        raw_end = _raw_offset(f, end)
+        while _raw_offset(f, current_position) + seek_jump < raw_end:
+            # Jump in the file.
+            _skip(f, current_position, seek_jump)
+            # Throw away partial line.
+            f.readline()
 
-                # We need to make sure this is a unique line.
-                try:
-                    cur_chrom, cur_pos = get_locus(f.readline())
+            # We need to make sure this is a unique line.
+            try:
+                cur_chrom, cur_pos = get_locus(f.readline())
 
+                tell = f.tell()
+                next_chrom, next_pos = get_locus(f.readline())
+                while next_chrom == cur_chrom and next_pos == cur_pos:
                     tell = f.tell()
                     next_chrom, next_pos = get_locus(f.readline())
-                    while next_chrom == cur_chrom and next_pos == cur_pos:
-                        tell = f.tell()
-                        next_chrom, next_pos = get_locus(f.readline())
 
-                    # We found "new" content.
-                    # First we make sure that the file looks sorted. Then, we
-                    # index it.
-                    code = encode_locus(next_chrom, next_pos)
-                    if index[-1][0] > code:
-                        raise Exception("This file is not sorted.")
+            except EndOfFile:
+                break  # Reached the end of the file.
 
-                    index.append((code, tell))
-                    current_position = tell
+            if tell >= end:
+                break  # Reached the end of the chunk.
 
-                except EndOfFile:
-                    break  # Reached the end of the file.
+            if next_chrom != index[-1][0]:
+                add_contig_starts(current_position, tell)
 
-    index = np.array(index)
+            # We found "new" content.
+            add_locus(next_chrom, next_pos, tell)
+            current_position = tell
 
-    # Create a dict containing the relevant information to be able to find the
-    # chromosome and position columns.
-    info = {"chrom_col": chrom_col, "pos_col": pos_col, "delimiter": delimiter,
-            "chrom_codes": encoding["chromosomes"]}
+        # The contigs starting after the last jump.
+        add_contig_starts(current_position, end)
 
-    pickle_string = pickle.dumps(info)
+    return index, None
 
-    # Write the index pickle (and numpy matrix).
-    with open(idx_fn, "wb") as f:
-        f.write(pickle_string)
-        np.save(f, index)
 
-    return idx_fn
+def _index_chunk_scan(f, index, add_locus, get_locus, end, seek_jump, bloom):
+    """Index a chunk by reading all the lines (see :py:func:`_index_chunk`).
+
+    In sparse mode (if ``seek_jump`` is not ``None``), a new locus is indexed
+    when it is at least ``seek_jump`` bytes after the last indexed locus, or
+    if it is the first locus of a contig. For BGZF files, the distance is
+    measured in uncompressed bytes (using the compression ratio).
+
+    """
+    if bloom is not None:
+        bloom = _BloomFilter(*bloom)
+        batch = [index[-1][:2]]
+
+    if seek_jump is not None and isinstance(f, bgzf.BgzfFile):
+        seek_jump /= f.compression_ratio
+
+    prev = index[-1][:2]
+    skipped = 0
+
+    tell = f.tell()
+    line = f.readline()
+    while line and tell < end:
+        locus = get_locus(line)
 
+        if locus != prev:
+            if locus[0] == prev[0] and locus[1] < prev[1]:
+                raise Exception("This file is not sorted.")
 
-def get_index(fn):
-    """Restores the index for a given file or builds it if the index was not
-       previously created.
+            if (seek_jump is None or locus[0] != prev[0] or
+                    skipped >= seek_jump):
+                add_locus(locus[0], locus[1], tell)
+                skipped = 0
+            prev = locus
 
-    :param fn: The filname of the file to index.
+            if bloom is not None:
+                batch.append(locus)
+                if len(batch) >= 65536:
+                    bloom.add(*zip(*batch))
+                    batch = []
+
+        skipped += len(line)
+        tell = f.tell()
+        line = f.readline()
+
+    if bloom is None:
+        return index, None
+
+    if batch:
+        bloom.add(*zip(*batch))
+    return index, bloom.bits
+
+
+class IndexedFile(object):
+    """An indexed file that can be queried from multiple threads.
+
+    :param fn: The filename of the indexed file (plain text or BGZF).
     :type fn: str
 
-    :returns: The numpy array representing the actual index.
-    :rtype: :py:class:`numpy.ndarray`
+    :param index: The index (it is loaded using :py:func:`get_index` if it is
+                  not given).
+    :type index: :py:class:`Index`
+
+    All the lookups use positional reads on a single file descriptor (the
+    file cursor is never shared), so a single ``IndexedFile`` can serve
+    lookups from many threads (e.g. from a thread pool or an ``asyncio``
+    executor) concurrently.
+
+    This also implements the context manager interface.
+
+    Usage: ::
+
+        with IndexedFile(fn) as f:
+            for line in f.query("chr1", 1000000, 1500000):
+                print(line)
 
     """
+    def __init__(self, fn, index=None):
+        self.filename = fn
+        self.index = get_index(fn) if index is None else index
 
-    # Read the information pickle part.
-    # We use the numpy format definition to know when to stop:
-    # https://github.com/numpy/numpy/blob/master/doc/neps/npy-format.rst
-    indexed_filename = fn
-    fn = _get_index_fn(indexed_filename)
-    with open(fn, "rb") as f:
-        i = 0
-        chunk = None
-        while chunk != b"\x93NUMPY":
-            f.seek(i)
-            chunk = f.read(6)
-            if not chunk:
-                raise Exception("Invalid format for the index.")
-            i += 1
+        # Make sure that the file can be opened (and that it's not gzip).
+        open_file(fn).close()
 
-        pickle_length = f.tell() - 6
-        f.seek(0)
-        info = pickle.loads(f.read(pickle_length))
+        self._file = open(fn, "rb")
+        self._is_bgzf = self.index.info.get("compression") == "bgzf"
 
-        index = np.load(f)
+        # Plain files are memory mapped (for the bisection of the lines).
+        self._mmap = None
+        if not self._is_bgzf:
+            self._mmap = _mmap_file(self._file)
 
-    # This is a class that will behave like the (info, index) tuple.
-    # It is only used to make it printing the index object prettier.
-    class Index(object):
-        def __init__(self, info, index, filename):
-            self.filename = filename
-            self.info = info
-            self.index = index
-
-        def __getitem__(self, key):
-            if key == 0:
-                return self.info
-            elif key == 1:
-                return self.index
-            else:
-                raise IndexError()
+        if hasattr(os, "pread"):
+            fd = self._file.fileno()
+            self._pread = functools.partial(os.pread, fd)
+        else:
+            # There are no positional reads on this platform.
+            self._lock = threading.Lock()
+            self._pread = self._locked_pread
 
-        def __iter__(self):
-            return (i for i in (self.info, self.index))
+    def _locked_pread(self, size, offset):
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(size)
 
-        def __repr__(self):
-            return "<{} object for file '{}'>".format(self.__class__.__name__,
-                                                      indexed_filename)
+    def _cursor(self):
+        """Creates a file-like object with its own cursor."""
+        if self._is_bgzf:
+            return bgzf.BgzfFile(self.filename, pread=self._pread)
+        return _PositionalFile(self._pread, self._mmap)
 
-    return Index(info, index, fn)
+    def get(self, chrom, pos):
+        """Get the lines for a locus.
 
+        :param chrom: The queried chromosome.
+        :param pos: The queried position on the chromosome.
 
-def goto(f, index, chrom, pos):
-    """Given a file, a locus and the index, go to the genomic coordinates.
+        :returns: The lines for the locus (an empty list if it isn't in the
+                  file).
+        :rtype: list
 
-    :param f: An open file.
-    :type f: file
+        """
+        if not self.index.might_contain(chrom, pos):
+            return []
+        return list(query(self._cursor(), self.index, chrom, pos, pos))
 
-    :param index: This is actually a tuple. The first element is an information
-                  dict containing the delimiter, chromosome column and position
-                  column. The second element is a numpy matrix containing the
-                  encoded loci and the "tell" positions.
-    :param index: tuple
+    def query(self, chrom, start, end):
+        """Get the lines of a region.
 
-    :param chrom: The queried chromosome.
-    :param pos: The queried position on the chromosome.
+        :param chrom: The queried chromosome.
+        :param start: The start of the region (inclusive).
+        :param end: The end of the region (inclusive).
 
-    :returns: True if the position was found and the cursor moved, False if
-              the queried chromosome, position wasn't found.
-    :rtype: bool
+        :returns: A generator of the lines located in the region.
+        :rtype: generator
+
+        """
+        return query(self._cursor(), self.index, chrom, start, end)
+
+    def find_loci(self, loci):
+        """Find the file positions of many loci (see :py:func:`find_loci`).
+
+        :param loci: An iterable of ``(chrom, pos)`` tuples.
+        :type loci: list
+
+        :returns: The ``tell`` for every locus or -1 if it was not found.
+        :rtype: :py:class:`numpy.ndarray`
+
+        """
+        return find_loci(self._cursor(), self.index, loci)
+
+    def overlaps(self, chrom, start, end):
+        """Get the lines overlapping a region (for interval indices, see
+        :py:func:`query_overlaps`).
+
+        :param chrom: The queried chromosome.
+        :param start: The start of the region (inclusive).
+        :param end: The end of the region (inclusive).
+
+        :returns: A generator of the lines (in the file order).
+        :rtype: generator
+
+        """
+        return query_overlaps(self._cursor(), self.index, chrom, start, end)
+
+    def readline(self, offset):
+        """Read the line at a given ``tell`` (e.g. from
+        :py:func:`find_loci`).
+
+        """
+        cursor = self._cursor()
+        cursor.seek(offset)
+        return cursor.readline()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+    def __repr__(self):
+        return "<{} object for file '{}'>".format(self.__class__.__name__,
+                                                  self.filename)
+
+
+class _PositionalFile(object):
+    """A read-only text file with its own cursor, reading using a positional
+    read function (``pread(size, offset)``).
+
+    The (optional) shared memory map of the file is used by
+    :py:func:`goto_fine` and :py:func:`query`.
 
     """
+    _chunk_size = 1 << 16
 
-    # Type checks for the parameters.
-    chrom = str(chrom)
-    if chrom.startswith("chr"):
-        chrom = chrom[3:]
-    pos = int(pos)
+    def __init__(self, pread, mmap=None):
+        self._pread = pread
+        self.mmap = mmap
+        self._buffer = b""
+        self._buffer_offset = 0
+        self._pos = 0
 
-    info, index = index
+    def seek(self, offset):
+        self._pos = int(offset)
 
-    # Encode the locus.
-    chrom_code = info["chrom_codes"].get(str(chrom))
-    if chrom_code is None:
-        raise ChromosomeNotIndexed(
-            "Chromosome '{}' is not in the index.".format(chrom)
-        )
+    def tell(self):
+        return self._pos
 
-    code = chrom_code * MAGIC_NUMBER + pos
-    logging.debug("Looking for code: {}".format(code))
+    def readline(self):
+        chunks = []
+        while True:
+            within = self._pos - self._buffer_offset
+            if not 0 <= within < len(self._buffer):
+                self._buffer = self._pread(self._chunk_size, self._pos)
+                self._buffer_offset = self._pos
+                within = 0
+                if not self._buffer:
+                    break
 
-    # Find the boundaries for the locus.
-    boundary = bisect.bisect_left(index[:, 0], code)
+            i = self._buffer.find(b"\n", within)
+            if i == -1:
+                chunks.append(self._buffer[within:])
+                self._pos = self._buffer_offset + len(self._buffer)
+                continue
 
-    # The hit is at the end of the index.
-    if boundary == index.shape[0]:
-        logging.debug("Looking from the end of the index.")
-        return goto_fine(f, chrom, pos, index[-1][1], float("+infinity"), info)
+            chunks.append(self._buffer[within:i + 1])
+            self._pos = self._buffer_offset + i + 1
+            break
 
-    if index[boundary, 0] == code:
-        # We got a direct hit.
-        logging.debug("Direct hit on locus.")
-        f.seek(index[boundary, 1])
-        return True
+        return b"".join(chunks).decode("utf-8")
 
-    # We always index the first position, so nothing should come before unless
-    # it's a direct hit.
-    if boundary == 0:
-        logging.debug("Locus before first index.")
 
-    left = index[boundary - 1, 1]
-    left_code = index[boundary, 0]
-    try:
-        right = index[boundary + 1, 1]
-        right_code = index[boundary + 1, 0]
-    except IndexError:
-        right = float("+infinity")  # Right boundary not in index, use the EOF.
-        right_code = float("+infinity")
+def open_file(fn):
+    """Opens a file that can be indexed.
 
-    logging.debug("Found boundaries: {}:{} and {}:{}. Using linear search to "
-                  "find the exact position.".format(left_code, left,
-                                                    right_code, right))
-    return goto_fine(f, chrom, pos, left, right, info)
+    :param fn: The filename.
+    :type fn: str
 
+    :returns: The opened file (a :py:class:`gepyto.formats.bgzf.BgzfFile`
+              for BGZF compressed files).
+    :rtype: file
 
-def goto_fine(f, chrom, pos, left, right, info):
+    Plain gzip files can't be indexed because they are not seekable. They
+    have to be compressed using ``bgzip`` instead.
 
-    # Go to the start of the plausible region.
-    f.seek(left)
+    """
+    if bgzf.is_bgzf(fn):
+        return bgzf.BgzfFile(fn)
 
-    # Bind some parameters to the line parser.
-    get_locus = functools.partial(
-        _get_locus,
-        chrom_col=info["chrom_col"],
-        pos_col=info["pos_col"],
-        delimiter=info["delimiter"],
-    )
+    if bgzf.is_gzip(fn):
+        raise Exception("File '{}' is gzip compressed, but not with BGZF "
+                        "(use bgzip to compress it).".format(fn))
 
-    # Iterate through the file.
-    while True:
-        here = f.tell()
+    return open(fn, "r")
 
-        try:
-            this_chrom, this_pos = get_locus(f.readline())
 
-            # We got it!
-            if this_chrom == chrom and this_pos == pos:
-                f.seek(here)
-                return True
+def _seek_raw(f, offset):
+    """Moves close to a position in the raw (compressed) file.
 
-        except EndOfFile:
-            logging.debug("Reached end of file without finding the locus.")
-            return False
+    For BGZF files, this moves to the first block at or after the position.
 
-        if here > right:
-            logging.debug("Didn't find the locus before the right boundary.")
-            return False
+    """
+    if isinstance(f, bgzf.BgzfFile):
+        f.seek_block(offset)
+    else:
+        f.seek(offset)
+
+
+def _skip(f, tell, n_bytes):
+    """Moves about ``n_bytes`` (of the raw file) after a ``tell``.
+
+    For BGZF files, the jump is made in the uncompressed data of the block
+    (using the compression ratio) when it doesn't go past the block, so that
+    sparse indices are not limited to one locus per block.
+
+    """
+    if not isinstance(f, bgzf.BgzfFile):
+        f.seek(tell + int(n_bytes))
+        return
+
+    block_offset, within = bgzf.split_virtual_offset(tell)
+    f.seek(tell)  # Loads the block (for the compression ratio).
+    within += int(n_bytes / f.compression_ratio)
+    if within < 1 << 16:
+        # Past the end of the data, this is the start of the next block.
+        f.seek(bgzf.make_virtual_offset(block_offset, within))
+    else:
+        f.seek_block(block_offset + int(n_bytes))
+
+
+def _raw_offset(f, tell):
+    """Converts a ``tell`` to a position in the raw (compressed) file."""
+    if isinstance(f, bgzf.BgzfFile):
+        return bgzf.split_virtual_offset(tell)[0]
+    return tell
+
+
+def _eof_tell(f, size):
+    """Returns the ``tell`` representing the end of a file of a given size."""
+    if isinstance(f, bgzf.BgzfFile):
+        return bgzf.make_virtual_offset(size, 0)
+    return size
+
+
+class Index(object):
+    """An index for a text file.
+
+    :param info: The information dict (delimiter, chromosome and position
+                 columns, contigs, etc.).
+    :type info: dict
+
+    :param positions: The indexed positions (sorted for every contig).
+    :type positions: :py:class:`numpy.ndarray`
+
+    :param offsets: The ``tell`` of the indexed lines.
+    :type offsets: :py:class:`numpy.ndarray`
+
+    :param contig_starts: The first row of every contig in the ``positions``
+                          and ``offsets`` arrays (with the total number of
+                          rows at the end).
+    :type contig_starts: :py:class:`numpy.ndarray`
+
+    The rows are in the same order as the lines of the indexed file. For
+    compatibility, this object also behaves like the ``(info, index)`` tuple
+    of the previous versions, where the index has the locus code
+    (``(contig + 1) * MAGIC_NUMBER + pos``) and the ``tell`` as columns (see
+    :py:attr:`table`). The :py:attr:`contig_table` has the contig, the
+    position and the ``tell`` as separate columns.
+
+    """
+    def __init__(self, info, positions, offsets, contig_starts, filename=None,
+                 bloom=None):
+        self.filename = filename
+        self.info = info
+        self.positions = positions
+        self.offsets = offsets
+        self.contig_starts = contig_starts
+        self.bloom = bloom
+
+    def might_contain(self, chrom, pos):
+        """Checks if a locus might be in the file (using the Bloom filter).
+
+        :returns: False if the locus is definitely not in the file. This is
+                  always True if the index has no Bloom filter.
+        :rtype: bool
+
+        """
+        if self.bloom is None:
+            return True
+        return bool(self.bloom.contains([_normalize_chrom(chrom)],
+                                        [int(pos)])[0])
+
+    def contig_rows(self, chrom):
+        """Returns the rows (as a ``(start, end)`` tuple) for a contig."""
+        chrom = _normalize_chrom(chrom)
+        code = self.info["chrom_codes"].get(chrom)
+        if code is None:
+            raise ChromosomeNotIndexed(
+                "Chromosome '{}' is not in the index.".format(chrom)
+            )
+        return int(self.contig_starts[code]), int(self.contig_starts[code + 1])
+
+    def find(self, chrom, pos):
+        """Find the last indexed row at or before a locus.
+
+        :returns: The row (which can be in a previous contig, or -1 if the
+                  locus is before the first indexed line) and a boolean
+                  indicating if the locus itself is indexed.
+        :rtype: tuple
+
+        """
+        start, end = self.contig_rows(chrom)
+        row = start + int(np.searchsorted(self.positions[start:end], pos,
+                                          side="right")) - 1
+        return row, row >= start and self.positions[row] == pos
+
+    @property
+    def contig_codes(self):
+        """The contig code of every row."""
+        return np.repeat(np.arange(len(self.info["contigs"])),
+                         np.diff(self.contig_starts))
+
+    @property
+    def contig_table(self):
+        """The ``(contig code, position, tell)`` table of the rows."""
+        return np.column_stack((self.contig_codes, self.positions,
+                                self.offsets))
+
+    @property
+    def table(self):
+        """The ``(locus code, tell)`` table of the rows (the format of the
+        previous versions, where the locus code is
+        ``(contig + 1) * MAGIC_NUMBER + pos``).
+
+        """
+        codes = (self.contig_codes.astype(np.int64) + 1) * MAGIC_NUMBER
+        codes += self.positions
+        return np.column_stack((codes, self.offsets))
+
+    @property
+    def nbytes(self):
+        """The total size of the index arrays."""
+        nbytes = (self.positions.nbytes + self.offsets.nbytes +
+                  self.contig_starts.nbytes)
+        if self.bloom is not None:
+            nbytes += self.bloom.bits.nbytes
+        return nbytes
+
+    def __len__(self):
+        return self.positions.shape[0]
+
+    def __getitem__(self, key):
+        if key == 0:
+            return self.info
+        elif key == 1:
+            return self.table
+        else:
+            raise IndexError()
+
+    def __iter__(self):
+        return (i for i in (self.info, self.table))
+
+    def __repr__(self):
+        return "<{} object for file '{}'>".format(self.__class__.__name__,
+                                                  self.filename)
+
+
+def get_index(fn, use_cache=True):
+    """Restores the index for a given file.
+
+    :param fn: The filname of the indexed file.
+    :type fn: str
+
+    :param use_cache: Use the process-wide cache of loaded indices.
+    :type use_cache: bool
+
+    :returns: The index.
+    :rtype: :py:class:`Index` (or :py:class:`IntervalIndex`)
+
+    The loaded indices are kept in a least recently used cache (see
+    :py:func:`index_cache_info`). A cached index is reloaded if the indexed
+    file or the index file were modified.
+
+    """
+    indexed_filename = fn
+    fn = _get_index_fn(indexed_filename)
+
+    if not use_cache:
+        return _load_index(fn, indexed_filename)
+
+    stamp = _file_stamp(indexed_filename) + _file_stamp(fn)
+    index = _INDEX_CACHE.get(fn, stamp)
+    if index is None:
+        index = _load_index(fn, indexed_filename)
+        _INDEX_CACHE.put(fn, stamp, index)
+
+    return index
+
+
+def _load_index(fn, indexed_filename):
+    """Reads an index file."""
+    with open(fn, "rb") as f:
+        is_legacy = f.read(len(INDEX_MAGIC)) != INDEX_MAGIC
+
+    if is_legacy:
+        info, arrays = _read_legacy_index(fn)
+    else:
+        info, arrays = _read_index(fn)
+
+    if "index" in arrays:
+        # Composite codes (legacy indices and version 1 of the format).
+        info, arrays = _from_composite_codes(info, arrays["index"])
+
+    if info.get("kind") == "interval":
+        return IntervalIndex(info, arrays, indexed_filename)
+
+    bloom = None
+    if "bloom" in arrays:
+        bloom = _BloomFilter(info["bloom"]["n_bits"],
+                             info["bloom"]["n_hashes"], arrays["bloom"])
+
+    return Index(info, arrays["positions"], arrays["offsets"],
+                 arrays["contig_starts"], indexed_filename, bloom)
+
+
+def _file_stamp(fn):
+    """Returns a tuple that changes when a file is modified or replaced."""
+    st = os.stat(fn)
+    return (st.st_ino, st.st_size, getattr(st, "st_mtime_ns", st.st_mtime))
+
+
+class _IndexCache(object):
+    """A thread-safe least recently used cache of indices, bounded by the
+    total number of bytes of the index arrays.
+
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()  # key -> (stamp, index)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, stamp):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != stamp:
+                self.misses += 1
+                return None
+
+            # Move the entry to the end (most recently used).
+            del self._entries[key]
+            self._entries[key] = entry
+
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, stamp, index):
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1].nbytes
+
+            if index.nbytes > self.max_bytes:
+                return
+
+            self._entries[key] = (stamp, index)
+            self._bytes += index.nbytes
+            self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes:
+            _, (_, index) = self._entries.popitem(last=False)
+            self._bytes -= index.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self._entries), "bytes": self._bytes,
+                    "max_bytes": self.max_bytes}
+
+
+_INDEX_CACHE = _IndexCache(INDEX_CACHE_MAX_BYTES)
+
+
+def index_cache_info():
+    """Statistics on the cache of loaded indices.
+
+    :returns: A dict with the number of ``hits`` and ``misses``, the number of
+              cached indices (``entries``), their total size in bytes
+              (``bytes``) and the maximal size of the cache (``max_bytes``).
+    :rtype: dict
+
+    """
+    return _INDEX_CACHE.info()
+
+
+def set_index_cache_size(max_bytes):
+    """Sets the maximal total size (in bytes) of the cached indices.
+
+    :param max_bytes: The size (0 disables the cache).
+    :type max_bytes: int
+
+    """
+    with _INDEX_CACHE._lock:
+        _INDEX_CACHE.max_bytes = max_bytes
+        _INDEX_CACHE._evict()
+
+
+def clear_index_cache():
+    """Empties the cache of loaded indices and resets the statistics."""
+    _INDEX_CACHE.clear()
+
+
+def _from_composite_codes(info, index):
+    """Converts an index using ``chrom_code * MAGIC_NUMBER + pos`` codes."""
+    info = dict(info)
+    chrom_codes = sorted(info["chrom_codes"].items(), key=lambda i: i[1])
+    info["contigs"] = [chrom for chrom, code in chrom_codes]
+    info["chrom_codes"] = dict(
+        (chrom, i) for i, chrom in enumerate(info["contigs"])
+    )
+    info.setdefault("compression", None)
+
+    index = np.asarray(index, dtype=np.int64).reshape(-1, 2)
+    codes = [code for chrom, code in chrom_codes]
+    contig_starts = np.searchsorted(index[:, 0] // MAGIC_NUMBER,
+                                    codes + [codes[-1] + 1 if codes else 0])
+
+    positions = index[:, 0] % MAGIC_NUMBER
+    return info, {
+        "positions": positions.astype(_positions_dtype(positions)),
+        "offsets": index[:, 1].copy(),
+        "contig_starts": contig_starts.astype(np.int64),
+    }
+
+
+def _write_index(fn, info, arrays):
+    """Write an index file.
+
+    :param fn: The index filename.
+    :type fn: str
+
+    :param info: The metadata (has to be serializable to JSON).
+    :type info: dict
+
+    :param arrays: The numpy arrays to store (by name).
+    :type arrays: dict
+
+    The file starts with a fixed size header (magic string, format version,
+    length of the metadata block and offset of the data), followed by the
+    JSON metadata and the raw arrays. Every array is aligned on
+    ``INDEX_ALIGNMENT`` bytes so that it can be memory mapped.
+
+    The file is written next to the destination and then renamed, so that
+    processes that have the previous version of the index mapped in memory
+    are not affected.
+
+    """
+    arrays = dict(
+        (name, np.ascontiguousarray(a)) for name, a in arrays.items()
+    )
+
+    # Compute the layout of the data section.
+    layout = {}
+    offset = 0
+    for name in sorted(arrays.keys()):
+        a = arrays[name]
+        layout[name] = {"dtype": a.dtype.str, "shape": list(a.shape),
+                        "offset": offset}
+        offset += _align(a.nbytes)
+
+    metadata = json.dumps({"info": info, "arrays": layout},
+                          sort_keys=True).encode("utf-8")
+    data_offset = _align(INDEX_HEADER.size + len(metadata))
+
+    tmp_fn = "{}.tmp{}".format(fn, os.getpid())
+    with open(tmp_fn, "wb") as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_FORMAT_VERSION,
+                                  len(metadata), data_offset))
+        f.write(metadata)
+
+        for name in sorted(arrays.keys()):
+            f.seek(data_offset + layout[name]["offset"])
+            arrays[name].tofile(f)
+
+        # Pad the file so that the last array is completely in the file.
+        f.truncate(data_offset + offset)
+
+    os.rename(tmp_fn, fn)
+
+
+def _read_index(fn):
+    """Read an index file written by :py:func:`_write_index`.
+
+    :param fn: The index filename.
+    :type fn: str
+
+    :returns: A tuple of the metadata and of a dict of read-only
+              :py:class:`numpy.memmap` (by name).
+    :rtype: tuple
+
+    Only the header and the metadata are read, the arrays are memory mapped.
+
+    """
+    with open(fn, "rb") as f:
+        header = f.read(INDEX_HEADER.size)
+        if len(header) != INDEX_HEADER.size:
+            raise Exception("Invalid format for the index.")
+
+        magic, version, metadata_length, data_offset = INDEX_HEADER.unpack(
+            header
+        )
+        if magic != INDEX_MAGIC:
+            raise Exception("Invalid format for the index.")
+
+        if version > INDEX_FORMAT_VERSION:
+            raise Exception("Index format version {} is not supported (use a "
+                            "more recent version of gepyto).".format(version))
+
+        metadata = json.loads(f.read(metadata_length).decode("utf-8"))
+
+    arrays = {}
+    for name, layout in metadata["arrays"].items():
+        shape = tuple(layout["shape"])
+        if 0 in shape:
+            # Empty arrays can't be memory mapped.
+            arrays[name] = np.empty(shape, dtype=layout["dtype"])
+            continue
+
+        arrays[name] = np.memmap(fn, dtype=layout["dtype"], mode="r",
+                                 offset=data_offset + layout["offset"],
+                                 shape=shape)
+
+    return metadata["info"], arrays
+
+
+def _read_legacy_index(fn):
+    """Read an index file created by gepyto < 0.9.3 (pickle and numpy)."""
+    # Read the information pickle part.
+    # We use the numpy format definition to know when to stop:
+    # https://github.com/numpy/numpy/blob/master/doc/neps/npy-format.rst
+    with open(fn, "rb") as f:
+        i = 0
+        chunk = None
+        while chunk != b"\x93NUMPY":
+            f.seek(i)
+            chunk = f.read(6)
+            if not chunk:
+                raise Exception("Invalid format for the index.")
+            i += 1
+
+        pickle_length = f.tell() - 6
+        f.seek(0)
+        info = pickle.loads(f.read(pickle_length))
+
+        index = np.load(f)
+
+    return info, {"index": index}
+
+
+def _align(n):
+    """Round up to the next multiple of ``INDEX_ALIGNMENT``."""
+    return -(-n // INDEX_ALIGNMENT) * INDEX_ALIGNMENT
+
+
+def goto(f, index, chrom, pos):
+    """Given a file, a locus and the index, go to the genomic coordinates.
+
+    :param f: An open file.
+    :type f: file
+
+    :param index: The index (from :py:func:`get_index`).
+    :param index: :py:class:`Index`
+
+    :param chrom: The queried chromosome.
+    :param pos: The queried position on the chromosome.
+
+    :returns: True if the position was found and the cursor moved, False if
+              the queried chromosome, position wasn't found.
+    :rtype: bool
+
+    """
+
+    # Type checks for the parameters.
+    chrom = _normalize_chrom(chrom)
+    pos = int(pos)
+
+    # Find the boundaries for the locus.
+    row, hit = index.find(chrom, pos)
+
+    if not hit and not index.might_contain(chrom, pos):
+        logging.debug("Locus not in the Bloom filter.")
+        return False
+
+    if hit:
+        # We got a direct hit.
+        logging.debug("Direct hit on locus.")
+        f.seek(index.offsets[row])
+        return True
+
+    if row < 0:
+        logging.debug("Locus before first index.")
+
+    left = index.offsets[max(row, 0)]
+    if row + 1 < len(index):
+        right = index.offsets[row + 1]
+    else:
+        right = None  # Right boundary not in index, use the EOF.
+
+    logging.debug("Found boundaries: {} and {}. Using linear search to find "
+                  "the exact position.".format(left, right))
+    return goto_fine(f, chrom, pos, left, right, index.info)
+
+
+def find_loci(f, index, loci):
+    """Find the file positions of many loci in a single pass over the file.
+
+    :param f: An open file.
+    :type f: file
+
+    :param index: The index (from :py:func:`get_index`).
+    :type index: :py:class:`Index`
+
+    :param loci: An iterable of ``(chrom, pos)`` tuples.
+    :type loci: list
+
+    :returns: The seek position of the first line for every locus (in the same
+              order as the queries) or -1 if the locus was not found.
+    :rtype: :py:class:`numpy.ndarray`
+
+    The queries are sorted and bisected together, and the file is read from
+    start to end without ever seeking backwards. This is a lot faster than
+    calling :py:func:`goto` for large numbers of loci.
+
+    """
+    info = index.info
+
+    codes = []
+    positions = []
+    for chrom, pos in loci:
+        chrom = _normalize_chrom(chrom)
+        if chrom not in info["chrom_codes"]:
+            raise ChromosomeNotIndexed(
+                "Chromosome '{}' is not in the index.".format(chrom)
+            )
+        codes.append(info["chrom_codes"][chrom])
+        positions.append(int(pos))
+
+    codes = np.array(codes, dtype=np.int64)
+    positions = np.array(positions, dtype=np.int64)
+    offsets = np.full(codes.shape[0], -1, dtype=np.int64)
+
+    # Skip the loci that are definitely not in the file.
+    queries = np.arange(codes.shape[0])
+    if index.bloom is not None and codes.shape[0] > 0:
+        queries = queries[index.bloom.contains(
+            [info["contigs"][code] for code in codes], positions
+        )]
+        codes = codes[queries]
+        positions = positions[queries]
+
+    if codes.shape[0] == 0:
+        return offsets
+
+    # Sort the queries and find the closest indexed locus for all of them
+    # (one contig at a time).
+    order = np.lexsort((positions, codes))
+    codes = codes[order]
+    positions = positions[order]
+
+    rows = np.empty(codes.shape[0], dtype=np.int64)
+    for code in np.unique(codes):
+        lo, hi = np.searchsorted(codes, [code, code + 1])
+        start, end = index.contig_starts[code], index.contig_starts[code + 1]
+        rows[lo:hi] = start + np.searchsorted(
+            index.positions[start:end], positions[lo:hi], side="right"
+        ) - 1
+
+    anchors = index.offsets[np.maximum(rows, 0)]
+
+    get_locus = functools.partial(
+        _get_locus,
+        chrom_col=info["chrom_col"],
+        pos_col=info["pos_col"],
+        delimiter=info["delimiter"],
+    )
+
+    # The current line (as a (code, pos) tuple) and the position of the next
+    # line.
+    cur_tell = -1
+    cur_locus = (-1, -1)
+    next_tell = -1
+
+    for i, code, pos, anchor in zip(queries[order], codes, positions,
+                                    anchors):
+        locus = (code, pos)
+
+        # Jump forward if the index knows a closer position.
+        if cur_locus < locus and anchor > next_tell:
+            f.seek(anchor)
+            next_tell = anchor
+
+        while cur_locus < locus:
+            cur_tell = next_tell
+            line = f.readline()
+            next_tell = f.tell()
+
+            if not line:
+                # After every contig.
+                cur_locus = (len(info["contigs"]), 0)
+                break
+
+            this_chrom, this_pos = get_locus(line)
+            this_code = info["chrom_codes"].get(this_chrom)
+            if this_code is not None:
+                cur_locus = (this_code, this_pos)
+
+        if cur_locus == locus:
+            offsets[i] = cur_tell
+
+    return offsets
+
+
+def query(f, index, chrom, start, end):
+    """Iterate over all the lines of a region.
+
+    :param f: An open file.
+    :type f: file
+
+    :param index: The index (from :py:func:`get_index`).
+    :type index: :py:class:`Index`
+
+    :param chrom: The queried chromosome.
+    :param start: The start of the region (inclusive).
+    :param end: The end of the region (inclusive).
+
+    :returns: A generator of the lines located in the region.
+    :rtype: generator
+
+    The cursor is moved to the closest indexed locus at or before the
+    ``start`` of the region and the lines are read until the ``end`` of the
+    region is passed.
+
+    """
+    chrom = _normalize_chrom(chrom)
+    start = int(start)
+    end = int(end)
+
+    # Find the last indexed locus at or before the start of the region.
+    row, _ = index.find(chrom, start)
+    left = index.offsets[max(row, 0)]
+    right = index.offsets[row + 1] if row + 1 < len(index) else None
+    return _iter_region(f, left, right, chrom, start, end, index.info)
+
+
+def _iter_region(f, left, right, chrom, start, end, info):
+    """Generates the lines of a region by reading from the ``left`` seek (the
+    ``right`` seek is the next indexed locus, or ``None``).
+
+    """
+    # Find the start of the region by bisection (if possible).
+    first = _bisect_file(f, left, right, chrom, start, info)
+    f.seek(left if first is None else first[0])
+
+    get_locus = functools.partial(
+        _get_locus,
+        chrom_col=info["chrom_col"],
+        pos_col=info["pos_col"],
+        delimiter=info["delimiter"],
+    )
+
+    in_chrom = False
+    line = f.readline()
+    while line:
+        this_chrom, this_pos = get_locus(line)
+
+        if this_chrom == chrom:
+            in_chrom = True
+            if this_pos > end:
+                return
+            if this_pos >= start:
+                yield line
+
+        elif in_chrom:
+            # We moved on to the next chromosome.
+            return
+
+        line = f.readline()
+
+
+def goto_fine(f, chrom, pos, left, right, info):
+    """Search for a locus between two positions of the file.
+
+    The ``right`` boundary can be ``None`` to search until the end of the
+    file.
+
+    For plain text files, the file is memory mapped and the lines between the
+    boundaries are bisected. Otherwise (e.g. for BGZF files), the lines are
+    read one by one.
+
+    """
+    found = _bisect_file(f, left, right, chrom, pos, info)
+    if found is not None:
+        if found[1] != (chrom, pos):
+            logging.debug("Didn't find the locus using bisection.")
+            return False
+
+        f.seek(found[0])
+        return True
+
+    # Go to the start of the plausible region.
+    f.seek(left)
+
+    # Bind some parameters to the line parser.
+    get_locus = functools.partial(
+        _get_locus,
+        chrom_col=info["chrom_col"],
+        pos_col=info["pos_col"],
+        delimiter=info["delimiter"],
+    )
+
+    # Iterate through the file.
+    while True:
+        here = f.tell()
+
+        try:
+            this_chrom, this_pos = get_locus(f.readline())
+
+            # We got it!
+            if this_chrom == chrom and this_pos == pos:
+                f.seek(here)
+                return True
+
+        except EndOfFile:
+            logging.debug("Reached end of file without finding the locus.")
+            return False
+
+        if right is not None and here > right:
+            logging.debug("Didn't find the locus before the right boundary.")
+            return False
+
+
+class _UnknownContig(Exception):
+    pass
+
+
+def _bisect_file(f, left, right, chrom, pos, info):
+    """Find the first line at or after a locus using a memory map of the file.
+
+    :returns: The position of the line and its ``(chrom, pos)`` (or ``None``
+              at the end of the file) or ``None`` if the file can't be memory
+              mapped (or if it has contigs that are not in the index between
+              the boundaries).
+    :rtype: tuple
+
+    """
+    chrom_code = info["chrom_codes"].get(chrom)
+    mm = _mmap_file(f)
+    if mm is None or chrom_code is None:
+        return None
+
+    def locus_at(start):
+        end = mm.find(b"\n", start)
+        if end == -1:
+            end = len(mm)
+        return _get_locus(mm[start:end].decode("utf-8"), info["chrom_col"],
+                          info["pos_col"], info["delimiter"])
+
+    def key_at(start):
+        this_chrom, this_pos = locus_at(start)
+        this_code = info["chrom_codes"].get(this_chrom)
+        if this_code is None:
+            raise _UnknownContig()
+        return this_code, this_pos
+
+    target = (chrom_code, pos)
+    lo = int(left)
+    hi = len(mm) if right is None else int(right)
+
+    try:
+        # The line at lo is before the locus and hi is the start of a line
+        # after the locus (or the end of the file).
+        while hi - lo > _BISECT_MIN_BYTES:
+            mid = (lo + hi) // 2
+            line_start = mm.find(b"\n", mid, hi - 1) + 1
+            if line_start == 0:
+                # No line starts between mid and hi.
+                break
+
+            if key_at(line_start) < target:
+                lo = line_start
+            else:
+                hi = line_start
+
+        # Finish with a linear search.
+        while lo < hi and key_at(lo) < target:
+            lo = mm.find(b"\n", lo) + 1
+            if lo == 0:
+                lo = len(mm)
+
+        if lo >= len(mm):
+            return lo, None
+        return lo, locus_at(lo)
+
+    except _UnknownContig:
+        return None
+
+    finally:
+        if getattr(f, "mmap", None) is not mm:
+            mm.close()
+
+
+def _mmap_file(f):
+    """Memory maps an open plain text file (returns None if it is not
+    possible).
+
+    """
+    mm = getattr(f, "mmap", None)
+    if mm is not None:
+        return mm
+
+    if isinstance(f, bgzf.BgzfFile) or not hasattr(f, "fileno"):
+        return None
+
+    try:
+        fileno = f.fileno()
+        if os.fstat(fileno).st_size == 0:
+            return None
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+    except (AttributeError, EnvironmentError, ValueError,
+            io.UnsupportedOperation):
+        return None
+
+
+def build_interval_index(fn, chrom_col, start_col, end_col, delimiter="\t",
+                         skip_lines=0, ignore_startswith=None):
+    """Build an interval index for a file of features (e.g. BED or GTF).
+
+    :param fn: The filename.
+    :type fn: str
+
+    :param chrom_col: The column representing the chromosome (0 based).
+    :type chrom_col: int
+
+    :param start_col: The column for the start of the features (0 based).
+    :type start_col: int
+
+    :param end_col: The column for the end of the features (0 based).
+    :type end_col: int
+
+    :param delimiter: The delimiter for the columns (default tab).
+    :type delimiter: str
+
+    :param skip_lines: Number of header lines to skip.
+    :type skip_lines: int
+
+    :param ignore_startswith: Ignore lines that start with a given string.
+                              This can be used to skip headers, but will not
+                              be used to parse the rest of the file.
+    :type ignore_startswith: str
+
+    :returns: The index filename.
+    :rtype: str
+
+    Every line of the file is indexed using a nested containment list
+    (Alekseyenko and Lee, 2007), so the file doesn't need to be sorted and
+    long features don't slow down the queries. The intervals are considered
+    closed (the start and the end are in the feature), use
+    :py:func:`query_overlaps` to find the lines overlapping a region.
+
+    """
+    assert len(set((chrom_col, start_col, end_col))) == 3
+
+    idx_fn = _get_index_fn(fn)
+
+    contigs = {}  # chrom -> lists of starts, ends and offsets.
+    with open_file(fn) as f:
+        is_bgzf = isinstance(f, bgzf.BgzfFile)
+        _skip_header(f, skip_lines, ignore_startswith)
+
+        tell = f.tell()
+        line = f.readline()
+        while line:
+            fields = line.rstrip().split(delimiter)
+
+            chrom = _normalize_chrom(fields[chrom_col])
+            start, end = int(fields[start_col]), int(fields[end_col])
+            if end < start:
+                raise Exception("Invalid interval ({}:{}-{}).".format(
+                    chrom, start, end
+                ))
+
+            if chrom not in contigs:
+                contigs[chrom] = ([], [], [])
+            contig = contigs[chrom]
+            contig[0].append(start)
+            contig[1].append(end)
+            contig[2].append(tell)
+
+            tell = f.tell()
+            line = f.readline()
+
+    # Build the containment lists for every contig.
+    names = sorted(contigs.keys())
+    arrays = []
+    tops = []
+    n = 0
+    for chrom in names:
+        starts, ends, offsets = (np.array(a, dtype=np.int64)
+                                 for a in contigs[chrom])
+        ncl = _build_ncl(starts, ends, offsets)
+        tops.append((n, n + ncl[-1]))
+
+        # The sublists are relative to the contig.
+        ncl[3][ncl[4] > 0] += n
+        ncl[4][ncl[4] > 0] += n
+
+        arrays.append(ncl[:-1])
+        n += starts.shape[0]
+
+    fields = ("starts", "ends", "offsets", "sub_starts", "sub_ends")
+    if arrays:
+        arrays = dict(
+            (name, np.concatenate([a[i] for a in arrays]))
+            for i, name in enumerate(fields)
+        )
+    else:
+        arrays = dict((name, np.empty(0, dtype=np.int64)) for name in fields)
+    arrays["tops"] = np.array(tops, dtype=np.int64).reshape(-1, 2)
+
+    info = {"kind": "interval", "chrom_col": chrom_col,
+            "start_col": start_col, "end_col": end_col,
+            "delimiter": delimiter, "contigs": names,
+            "chrom_codes": dict((chrom, i) for i, chrom in enumerate(names)),
+            "compression": "bgzf" if is_bgzf else None}
+
+    _write_index(idx_fn, info, arrays)
+
+    return idx_fn
+
+
+def _build_ncl(starts, ends, offsets):
+    """Builds a nested containment list.
+
+    :returns: The reordered starts, ends and offsets, the sublist boundaries
+              (``[sub_start, sub_end)`` for every interval, both 0 if there is
+              no sublist) and the length of the top level list (which is
+              first).
+    :rtype: tuple
+
+    Every (sub)list is sorted by start and no interval contains another in
+    a list, so the ends are also sorted.
+
+    """
+    n = starts.shape[0]
+
+    # Sort by start, and by decreasing end so that parents come first.
+    order = np.lexsort((-ends, starts))
+    starts = starts[order]
+    ends = ends[order]
+    offsets = offsets[order]
+
+    # Find the parent (smallest containing interval) of every interval.
+    parents = np.empty(n, dtype=np.int64)
+    stack = []
+    for i in range(n):
+        while stack and ends[stack[-1]] < ends[i]:
+            stack.pop()
+        parents[i] = stack[-1] if stack else -1
+        stack.append(i)
+
+    # Group the intervals by parent (the top level list is first).
+    layout = np.argsort(parents, kind="mergesort")
+    new_positions = np.empty(n, dtype=np.int64)
+    new_positions[layout] = np.arange(n)
+
+    sub_starts = np.zeros(n, dtype=np.int64)
+    sub_ends = np.zeros(n, dtype=np.int64)
+
+    sorted_parents = parents[layout]
+    groups, group_starts = np.unique(sorted_parents, return_index=True)
+    group_ends = np.append(group_starts[1:], n)
+    for parent, lo, hi in zip(groups, group_starts, group_ends):
+        if parent >= 0:
+            sub_starts[new_positions[parent]] = lo
+            sub_ends[new_positions[parent]] = hi
+
+    n_top = int(np.sum(parents == -1))
+    return [starts[layout], ends[layout], offsets[layout], sub_starts,
+            sub_ends, n_top]
+
+
+class IntervalIndex(object):
+    """An interval index (see :py:func:`build_interval_index`).
+
+    :param info: The information dict (delimiter, columns, contigs, etc.).
+    :type info: dict
+
+    :param arrays: The nested containment list arrays.
+    :type arrays: dict
+
+    """
+    def __init__(self, info, arrays, filename=None):
+        self.filename = filename
+        self.info = info
+        self.starts = arrays["starts"]
+        self.ends = arrays["ends"]
+        self.offsets = arrays["offsets"]
+        self.sub_starts = arrays["sub_starts"]
+        self.sub_ends = arrays["sub_ends"]
+        self.tops = arrays["tops"]
+
+    def find_overlaps(self, chrom, start, end):
+        """Find the intervals overlapping a region.
+
+        :param chrom: The queried chromosome.
+        :param start: The start of the region (inclusive).
+        :param end: The end of the region (inclusive).
+
+        :returns: The ``tell`` of the overlapping lines (sorted).
+        :rtype: :py:class:`numpy.ndarray`
+
+        """
+        chrom = _normalize_chrom(chrom)
+        code = self.info["chrom_codes"].get(chrom)
+        if code is None:
+            raise ChromosomeNotIndexed(
+                "Chromosome '{}' is not in the index.".format(chrom)
+            )
+
+        hits = []
+        lists = [tuple(self.tops[code])]
+        while lists:
+            lo, hi = lists.pop()
+
+            # The first interval ending after the start of the region.
+            i = lo + int(np.searchsorted(self.ends[lo:hi], start))
+            while i < hi and self.starts[i] <= end:
+                hits.append(i)
+                if self.sub_ends[i] > 0:
+                    lists.append((self.sub_starts[i], self.sub_ends[i]))
+                i += 1
+
+        return np.sort(self.offsets[hits])
+
+    @property
+    def nbytes(self):
+        """The total size of the index arrays."""
+        return sum(a.nbytes for a in (self.starts, self.ends, self.offsets,
+                                      self.sub_starts, self.sub_ends,
+                                      self.tops))
+
+    def __len__(self):
+        return self.starts.shape[0]
+
+    def __repr__(self):
+        return "<{} object for file '{}'>".format(self.__class__.__name__,
+                                                  self.filename)
+
+
+def query_overlaps(f, index, chrom, start, end):
+    """Iterate over the lines overlapping a region.
+
+    :param f: An open file.
+    :type f: file
+
+    :param index: The index (from :py:func:`get_index`).
+    :type index: :py:class:`IntervalIndex`
+
+    :param chrom: The queried chromosome.
+    :param start: The start of the region (inclusive).
+    :param end: The end of the region (inclusive).
+
+    :returns: A generator of the lines (in the file order).
+    :rtype: generator
+
+    """
+    offsets = index.find_overlaps(chrom, int(start), int(end))
+    return _iter_lines(f, offsets)
+
+
+def _iter_lines(f, offsets):
+    """Generates the lines starting at the given ``tell`` positions."""
+    for offset in offsets:
+        f.seek(offset)
+        yield f.readline()
+
+
+def _index_segments(index):
+    """Returns the raw (compressed) byte range of every indexed row (from its
+    offset to the offset of the next row) and the approximate number of
+    records in the ranges.
+
+    """
+    offsets = np.asarray(index.offsets, dtype=np.int64)
+    is_bgzf = index.info.get("compression") == "bgzf"
+    if is_bgzf:
+        offsets = offsets >> 16
+
+    data_size = index.info.get("data_size")
+    if data_size is None:
+        if index.filename is not None and os.path.isfile(index.filename):
+            data_size = os.path.getsize(index.filename)
+        else:
+            data_size = int(offsets[-1]) if len(offsets) else 0
+
+    n_bytes = np.diff(np.append(offsets, max(data_size, offsets[-1])))
+
+    # The mean size of the records (compressed), or the size of the indexed
+    # rows for older indices.
+    record_size = index.info.get("record_size")
+    if not record_size:
+        record_size = float(data_size - offsets[0]) / len(offsets)
+    n_records = n_bytes / float(record_size)
+
+    contig_codes = np.repeat(np.arange(len(index.info["contigs"])),
+                             np.diff(index.contig_starts))
+
+    return contig_codes, n_bytes, n_records
+
+
+def index_density(index, bin_size=1000000):
+    """Compute the density of records along the genome from an index.
+
+    :param index: The index (from :py:func:`get_index`).
+    :type index: :py:class:`Index`
+
+    :param bin_size: The size of the bins (in bases).
+    :type bin_size: int
+
+    :returns: A DataFrame with the ``chrom``, ``start``, ``end`` (inclusive),
+              ``n_records``, ``n_bytes``, ``records_per_mb`` and
+              ``bytes_per_mb`` of the non-empty bins.
+    :rtype: :py:class:`pandas.DataFrame`
+
+    The data file is not read: the bytes between two indexed rows are
+    assigned to the position of the first one and the number of records is
+    estimated from the mean record size (which is measured when the index is
+    built). The number of bytes are compressed bytes for BGZF files.
+
+    """
+    import pandas as pd
+
+    assert bin_size > 0
+    if len(index) == 0:
+        return pd.DataFrame(columns=["chrom", "start", "end", "n_records",
+                                     "n_bytes", "records_per_mb",
+                                     "bytes_per_mb"])
+
+    contig_codes, n_bytes, n_records = _index_segments(index)
+    bins = np.asarray(index.positions, dtype=np.int64) // bin_size
+
+    df = pd.DataFrame({"code": contig_codes, "bin": bins,
+                       "n_records": n_records, "n_bytes": n_bytes})
+    df = df.groupby(["code", "bin"], sort=True).sum().reset_index()
+
+    df["chrom"] = np.array(index.info["contigs"], dtype=object)[df["code"]]
+    df["start"] = df["bin"] * bin_size
+    df["end"] = df["start"] + bin_size - 1
+    df["records_per_mb"] = df["n_records"] * (1e6 / bin_size)
+    df["bytes_per_mb"] = df["n_bytes"] * (1e6 / bin_size)
+
+    return df[["chrom", "start", "end", "n_records", "n_bytes",
+               "records_per_mb", "bytes_per_mb"]]
+
+
+def contig_density(index):
+    """Compute the number of records of every contig from an index.
+
+    :param index: The index (from :py:func:`get_index`).
+    :type index: :py:class:`Index`
+
+    :returns: A DataFrame with the ``chrom``, the ``start`` and ``end`` (the
+              first and last indexed positions), ``n_records``, ``n_bytes``,
+              ``records_per_mb`` and ``bytes_per_mb`` of the contigs (in the
+              file order).
+    :rtype: :py:class:`pandas.DataFrame`
+
+    The numbers are estimated as for :py:func:`index_density`.
+
+    """
+    import pandas as pd
+
+    contigs = index.info["contigs"]
+    starts = np.asarray(index.contig_starts)
+    contig_codes, n_bytes, n_records = _index_segments(index)
+
+    df = pd.DataFrame({
+        "chrom": contigs,
+        "start": [int(index.positions[i]) for i in starts[:-1]],
+        "end": [int(index.positions[i - 1]) for i in starts[1:]],
+        "n_records": np.bincount(contig_codes, weights=n_records,
+                                 minlength=len(contigs)),
+        "n_bytes": np.bincount(contig_codes, weights=n_bytes,
+                               minlength=len(contigs)).astype(np.int64),
+    })
+
+    length = (df["end"] - df["start"] + 1) / 1e6
+    df["records_per_mb"] = df["n_records"] / length
+    df["bytes_per_mb"] = df["n_bytes"] / length
+
+    return df[["chrom", "start", "end", "n_records", "n_bytes",
+               "records_per_mb", "bytes_per_mb"]]
+
+
+def shard_index(index, n_shards):
+    """Split an indexed file into shards with about the same number of
+    records (e.g. to distribute the work on a cluster).
+
+    :param index: The index (from :py:func:`get_index`).
+    :type index: :py:class:`Index`
+
+    :param n_shards: The number of shards.
+    :type n_shards: int
+
+    :returns: A list of ``(chrom, start, end, byte_start, byte_end)`` tuples.
+    :rtype: list
+
+    The shards are computed from the index only. A shard never spans two
+    contigs, so there is at least one shard per contig (and there can be
+    more than ``n_shards`` shards). The shards are split at indexed rows, so
+    they never split the lines of a locus.
+
+    The ``start`` and ``end`` (inclusive) of the shards of a contig cover all
+    its positions: the ``start`` of the first shard and the ``end`` of the
+    last shard are ``None``. The ``[byte_start, byte_end)`` ranges (``tell``
+    positions, i.e. virtual offsets for BGZF files) cover all the data of the
+    file. For sparse indices, the lines at the start of a contig can be in
+    the byte range of the previous shard (they are before the first indexed
+    row of the contig).
+
+    """
+    assert n_shards >= 1
+
+    contigs = index.info["contigs"]
+    if not contigs:
+        return []
+
+    starts = np.asarray(index.contig_starts)
+    _, n_bytes, _ = _index_segments(index)
+    cum_bytes = np.concatenate(([0], np.cumsum(n_bytes)))
+
+    # Allocate the shards to the contigs (at least one per contig), using the
+    # largest remainders.
+    contig_bytes = cum_bytes[starts[1:]] - cum_bytes[starts[:-1]]
+    total = float(max(contig_bytes.sum(), 1))
+    share = contig_bytes / total * max(n_shards, len(contigs))
+    counts = np.maximum(np.floor(share).astype(int), 1)
+    remaining = max(n_shards, len(contigs)) - counts.sum()
+    if remaining > 0:
+        for i in np.argsort(counts - share)[:remaining]:
+            counts[i] += 1
+
+    # The (first) rows of the shards.
+    rows = []
+    for i in range(len(contigs)):
+        first, last = starts[i], starts[i + 1]
+        targets = np.linspace(cum_bytes[first], cum_bytes[last],
+                              counts[i] + 1)[1:-1]
+        # The cuts are rows of the contig (there can be more shards than
+        # rows, in which case some of the cuts are merged).
+        cuts = np.searchsorted(cum_bytes[first:last], targets) + first
+        cuts = np.clip(cuts, first, last - 1)
+        rows.extend(sorted(set([first] + [int(j) for j in cuts])))
+
+    if index.info.get("compression") == "bgzf":
+        end_tell = bgzf.make_virtual_offset(index.info["data_size"], 0)
+    else:
+        end_tell = index.info.get("data_size")
+    if end_tell is None:
+        end_tell = os.path.getsize(index.filename)
+
+    shards = []
+    code = -1
+    for i, row in enumerate(rows):
+        next_row = rows[i + 1] if i + 1 < len(rows) else len(index)
+        if row >= starts[code + 1]:
+            # First shard of the contig.
+            code += 1
+            start = None
+        else:
+            start = int(index.positions[row])
+
+        if next_row == starts[code + 1]:
+            # Last shard of the contig.
+            end = None
+        else:
+            end = int(index.positions[next_row]) - 1
+
+        shards.append((
+            contigs[code], start, end, int(index.offsets[row]),
+            int(index.offsets[next_row]) if next_row < len(index) else
+            int(end_tell),
+        ))
+
+    return shards
+
+
+def build_manifest(manifest_fn, fns, chrom_col=None, pos_col=None,
+                   delimiter="\t", skip_lines=0, index_rate=0.2,
+                   ignore_startswith=None, processes=1):
+    """Build a manifest for a set of indexed files (e.g. one file per
+    chromosome, or per chunk of a chromosome).
+
+    :param manifest_fn: The filename of the manifest.
+    :type manifest_fn: str
+
+    :param fns: The filenames of the files of the set.
+    :type fns: list
+
+    :returns: The filename of the manifest.
+    :rtype: str
+
+    The files that are not indexed yet are indexed using
+    :py:func:`build_index` (the other parameters are the same), so the
+    ``chrom_col`` and ``pos_col`` are only required if some files are not
+    indexed.
+
+    The manifest is a JSON file that lists the contigs of every file, with
+    the range of positions of the first and last contigs (the other contigs
+    are entirely in the file). The filenames are relative to the directory of
+    the manifest. Use :py:class:`IndexedFileSet` to query the set of files.
+
+    """
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_fn))
+
+    files = []
+    for fn in fns:
+        if not os.path.isfile(_get_index_fn(fn)):
+            if chrom_col is None or pos_col is None:
+                raise Exception("File '{}' is not indexed (the chrom_col and "
+                                "pos_col are required).".format(fn))
+            build_index(fn, chrom_col, pos_col, delimiter=delimiter,
+                        skip_lines=skip_lines, index_rate=index_rate,
+                        ignore_startswith=ignore_startswith,
+                        processes=processes)
+
+        files.append({
+            "filename": os.path.relpath(os.path.abspath(fn), manifest_dir),
+            "contigs": _file_contig_ranges(fn, get_index(fn)),
+        })
+
+    with open(manifest_fn, "w") as f:
+        json.dump({"format": "gepyto_manifest", "version": 1,
+                   "files": files}, f, indent=2)
+
+    return manifest_fn
+
+
+def _file_contig_ranges(fn, index):
+    """Returns the ``[chrom, start, end]`` ranges of the contigs of an indexed
+    file (``None`` if the range is not bounded).
+
+    """
+    contigs = index.info["contigs"]
+    if not contigs:
+        return []
+
+    get_locus = functools.partial(
+        _get_locus,
+        chrom_col=index.info["chrom_col"],
+        pos_col=index.info["pos_col"],
+        delimiter=index.info["delimiter"],
+    )
+
+    # The lines between the last indexed row of a contig and the first row of
+    # the next one are read to make sure that no contig is missing from the
+    # index (sparse indices of the previous versions could skip small
+    # contigs) and to get the last line of the file.
+    starts = index.contig_starts
+    last_line = None
+    with open_file(fn) as f:
+        for code, chrom in enumerate(contigs):
+            f.seek(index.offsets[starts[code + 1] - 1])
+            stop = None
+            if code + 1 < len(contigs):
+                stop = index.offsets[starts[code + 1]]
+
+            tell = f.tell()
+            line = f.readline()
+            while line and (stop is None or tell < stop):
+                if line.strip():
+                    if get_locus(line)[0] != chrom:
+                        raise Exception(
+                            "Contig '{}' of file '{}' is not indexed (use "
+                            "build_index to index the file again)."
+                            "".format(get_locus(line)[0], fn)
+                        )
+                    last_line = line
+                tell = f.tell()
+                line = f.readline()
+
+    # The first line of the file is always indexed.
+    ranges = [[chrom, None, None] for chrom in contigs]
+    ranges[0][1] = int(index.positions[0])
+    ranges[-1][2] = get_locus(last_line)[1]
+
+    return ranges
+
+
+class IndexedFileSet(object):
+    """A set of indexed files that can be queried as a single file.
+
+    :param manifest_fn: The filename of the manifest (from
+                        :py:func:`build_manifest`).
+    :type manifest_fn: str
+
+    :param max_open_files: The maximal number of files that are kept open.
+    :type max_open_files: int
+
+    The queries are routed to the files containing the queried contig and
+    range of positions. The files are opened (as :py:class:`IndexedFile`) when
+    they are first queried and the least recently used ones are closed when
+    there are more than ``max_open_files`` (files that are still read by a
+    query are never closed).
+
+    This also implements the context manager interface.
+
+    Usage: ::
+
+        build_manifest("cohort.json", ["chr{}.impute2".format(i)
+                                       for i in range(1, 23)], 0, 2, " ")
+        with IndexedFileSet("cohort.json") as f:
+            for line in f.query("chr1", 1000000, 1500000):
+                print(line)
+
+    """
+    def __init__(self, manifest_fn, max_open_files=16):
+        assert max_open_files >= 1
+        self.max_open_files = max_open_files
+
+        with open(manifest_fn, "r") as f:
+            manifest = json.load(f)
+        if manifest.get("format") != "gepyto_manifest":
+            raise Exception("File '{}' is not a manifest.".format(
+                manifest_fn
+            ))
+
+        manifest_dir = os.path.dirname(os.path.abspath(manifest_fn))
+        self.filenames = []
+
+        # The (start, end, file) ranges of every contig.
+        self._ranges = collections.defaultdict(list)
+        for i, entry in enumerate(manifest["files"]):
+            self.filenames.append(os.path.join(manifest_dir,
+                                               entry["filename"]))
+            for chrom, start, end in entry["contigs"]:
+                self._ranges[chrom].append((start, end, i))
+
+        for ranges in self._ranges.values():
+            ranges.sort(key=lambda r: (r[0] is not None, r[0], r[2]))
+
+        self._lock = threading.Lock()
+        self._handles = collections.OrderedDict()
+        self._users = collections.defaultdict(int)
+
+    @property
+    def contigs(self):
+        """The contigs of all the files."""
+        return list(self._ranges.keys())
+
+    def files_for(self, chrom, start, end=None):
+        """Get the files that might contain a locus or region.
+
+        :param chrom: The queried chromosome.
+        :param start: The start of the region (inclusive).
+        :param end: The end of the region (inclusive, defaults to the
+                    ``start``).
+
+        :returns: The filenames (in the order of the positions).
+        :rtype: list
+
+        """
+        return [self.filenames[i] for i in self._files_for(chrom, start, end)]
+
+    def _files_for(self, chrom, start, end=None):
+        if end is None:
+            end = start
+        return [
+            i for range_start, range_end, i in
+            self._ranges.get(_normalize_chrom(chrom), [])
+            if ((range_start is None or range_start <= end) and
+                (range_end is None or range_end >= start))
+        ]
+
+    def _acquire(self, i):
+        """Gets the (opened) file ``i`` and marks it as used."""
+        with self._lock:
+            handle = self._handles.pop(i, None)
+            if handle is None:
+                handle = IndexedFile(self.filenames[i])
+            self._handles[i] = handle
+            self._users[i] += 1
+
+            # Close the least recently used files.
+            n_open = len(self._handles)
+            for j in list(self._handles.keys()):
+                if n_open <= self.max_open_files:
+                    break
+                if self._users[j] == 0:
+                    self._handles.pop(j).close()
+                    n_open -= 1
+
+            return handle
+
+    def _release(self, i):
+        with self._lock:
+            self._users[i] -= 1
+
+    def get(self, chrom, pos):
+        """Get the lines for a locus (see :py:func:`IndexedFile.get`).
+
+        :param chrom: The queried chromosome.
+        :param pos: The queried position on the chromosome.
+
+        :returns: The lines for the locus (an empty list if it isn't in the
+                  files).
+        :rtype: list
+
+        """
+        lines = []
+        for i in self._files_for(chrom, pos):
+            handle = self._acquire(i)
+            try:
+                lines.extend(handle.get(chrom, pos))
+            finally:
+                self._release(i)
+        return lines
+
+    def query(self, chrom, start, end):
+        """Get the lines of a region (from all the files containing it).
+
+        :param chrom: The queried chromosome.
+        :param start: The start of the region (inclusive).
+        :param end: The end of the region (inclusive).
+
+        :returns: A generator of the lines located in the region.
+        :rtype: generator
+
+        """
+        for i in self._files_for(chrom, start, end):
+            handle = self._acquire(i)
+            try:
+                for line in handle.query(chrom, start, end):
+                    yield line
+            finally:
+                self._release(i)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            for handle in self._handles.values():
+                handle.close()
+            self._handles.clear()
+
+    def __repr__(self):
+        return "<{} object of {} files>".format(self.__class__.__name__,
+                                                len(self.filenames))
+
+
+def sort_and_index(fn, out_fn, chrom_col, pos_col, delimiter="\t",
+                   skip_lines=0, ignore_startswith=None, index_rate=0.2,
+                   processes=1, buffer_size=256 * 1024 ** 2, tmp_dir=None,
+                   bloom=False, bloom_fp_rate=0.01):
+    """Sort a (possibly very large) file by locus and index it.
+
+    :param fn: The filename of the file to sort (plain text or BGZF).
+    :type fn: str
+
+    :param out_fn: The filename of the sorted file (plain text).
+    :type out_fn: str
+
+    :param buffer_size: The approximate number of bytes of the input file
+                        that are sorted in memory (by every process).
+    :type buffer_size: int
+
+    :param tmp_dir: The directory for the temporary (sorted runs) files.
+    :type tmp_dir: str
+
+    :returns: The index filename (of the sorted file).
+    :rtype: str
+
+    The other parameters are the same as for :py:func:`build_index`.
+
+    This is an external merge sort: the file is split into runs of
+    ``buffer_size`` bytes that are sorted by worker processes and written to
+    temporary files. The runs are then merged and the index is built while the
+    sorted file is written. The header lines are copied as is.
+
+    Chromosomes are sorted in the natural order (1, 2, ..., 22, X, Y, MT and
+    then the other contigs alphabetically) and lines with the same locus stay
+    in the same order as in the input file.
+
+    """
+    assert chrom_col != pos_col
+    assert processes >= 1
+
+    get_locus = functools.partial(
+        _get_locus,
+        chrom_col=chrom_col,
+        pos_col=pos_col,
+        delimiter=delimiter
+    )
+
+    # Copy the header and find the runs (aligned on lines).
+    size = os.path.getsize(fn)
+    with open_file(fn) as f:
+        _skip_header(f, skip_lines, ignore_startswith)
+        start = f.tell()
+
+        raw_start = _raw_offset(f, start)
+        f.seek(0)
+        header = []
+        while f.tell() < start:
+            header.append(f.readline())
+
+        boundaries = [start]
+        for raw_offset in range(raw_start + buffer_size, size, buffer_size):
+            _seek_raw(f, raw_offset)
+            f.readline()  # Throw away partial line.
+            tell = f.tell()
+            if f.readline() and tell > boundaries[-1]:
+                boundaries.append(tell)
+        boundaries.append(_eof_tell(f, size))
+
+    runs = [
+        (fn, boundaries[i], boundaries[i + 1], chrom_col, pos_col, delimiter,
+         tmp_dir)
+        for i in range(len(boundaries) - 1)
+    ]
+
+    logging.debug("Sorting {} runs using {} processes.".format(len(runs),
+                                                               processes))
+    run_fns = []
+    try:
+        if processes == 1 or len(runs) == 1:
+            for run in runs:
+                run_fns.append(_sort_run(run))
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                run_fns = pool.map(_sort_run, runs)
+            finally:
+                pool.close()
+                pool.join()
+
+        return _merge_runs(run_fns, out_fn, header, get_locus, index_rate,
+                           bloom, bloom_fp_rate,
+                           {"chrom_col": chrom_col, "pos_col": pos_col,
+                            "delimiter": delimiter, "compression": None})
+
+    finally:
+        for run_fn in run_fns:
+            if os.path.isfile(run_fn):
+                os.remove(run_fn)
+
+
+def _sort_run(args):
+    """Sorts the lines of the ``[start, end)`` range of a file and writes them
+    to a temporary file (returns its filename).
+
+    """
+    fn, start, end, chrom_col, pos_col, delimiter, tmp_dir = args
+
+    lines = []
+    with open_file(fn) as f:
+        f.seek(start)
+        tell = start
+        line = f.readline()
+        while line and tell < end:
+            if not line.endswith("\n"):
+                line += "\n"
+            chrom, pos = _get_locus(line, chrom_col, pos_col, delimiter)
+            lines.append(((_chrom_sort_key(chrom), pos), line))
+
+            tell = f.tell()
+            line = f.readline()
+
+    # The sort is stable, so duplicated loci stay in the same order.
+    lines.sort(key=lambda l: l[0])
+
+    fd, run_fn = tempfile.mkstemp(prefix="gepyto_sort_", suffix=".txt",
+                                  dir=tmp_dir)
+    with io.open(fd, "wb") as f:
+        for _, line in lines:
+            f.write(line.encode("utf-8"))
+
+    return run_fn
+
+
+def _merge_runs(run_fns, out_fn, header, get_locus, index_rate, bloom,
+                bloom_fp_rate, info):
+    """Merges the sorted runs into the output file and indexes it."""
+    def read_run(i, run_fn):
+        with io.open(run_fn, "r", encoding="utf-8") as f:
+            for j, line in enumerate(f):
+                chrom, pos = get_locus(line)
+                # The run and line numbers keep the merge stable.
+                yield (_chrom_sort_key(chrom), pos), i, j, chrom, line
+
+    # Estimate the number of lines to compute the jump size (in sparse mode)
+    # and to size the Bloom filter.
+    data_size = sum(os.path.getsize(run_fn) for run_fn in run_fns)
+    n_lines = 0
+    for run_fn in run_fns:
+        with open(run_fn, "rb") as f:
+            for _ in f:
+                n_lines += 1
+
+    seek_jump = None
+    if index_rate != 1 and n_lines > 0:
+        seek_jump = data_size / float(n_lines) / index_rate
+
+    bloom_filter = None
+    if bloom:
+        bloom_filter = _BloomFilter.for_capacity(n_lines, bloom_fp_rate)
+        batch = []
+
+    contigs = []
+    contig_starts = []
+    positions = []
+    offsets = []
+    index = []
+
+    with open(out_fn, "wb") as out:
+        for line in header:
+            out.write(line.encode("utf-8"))
+        offset = out.tell()
+
+        prev = None
+        last_indexed = None
+        merged = heapq.merge(*[read_run(i, run_fn)
+                               for i, run_fn in enumerate(run_fns)])
+        for (_, pos), _, _, chrom, line in merged:
+            locus = (chrom, pos)
+            if locus != prev:
+                if (last_indexed is None or seek_jump is None or
+                        chrom != prev[0] or
+                        offset >= last_indexed + seek_jump):
+                    index.append((chrom, pos, offset))
+                    last_indexed = offset
+                prev = locus
+
+                if bloom_filter is not None:
+                    batch.append(locus)
+                    if len(batch) >= 65536:
+                        bloom_filter.add(*zip(*batch))
+                        batch = []
+
+            line = line.encode("utf-8")
+            out.write(line)
+            offset += len(line)
+
+    if bloom_filter is not None and batch:
+        bloom_filter.add(*zip(*batch))
+
+    _merge_chunk(index, contigs, contig_starts, positions, offsets)
+
+    info = dict(info)
+    info["data_size"] = os.path.getsize(out_fn)
+    info["seek_jump"] = seek_jump
+    if n_lines > 0:
+        info["record_size"] = data_size / float(n_lines)
+
+    idx_fn = _get_index_fn(out_fn)
+    _write_contig_index(idx_fn, info, contigs, contig_starts, positions,
+                        offsets, bloom_filter)
+
+    return idx_fn
+
+
+def _chrom_sort_key(chrom):
+    """The natural order of chromosomes (numbers first, then the sexual and
+    mitochondrial chromosomes and then the other contigs).
+
+    """
+    if chrom.isdigit():
+        return (0, int(chrom), "")
+    if chrom in _CHROM_ORDER:
+        return (1, _CHROM_ORDER[chrom], "")
+    return (2, 0, chrom)
 
 
 def _get_index_fn(fn):
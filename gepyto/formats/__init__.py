@@ -15,7 +15,9 @@ __license__ = "Attribution-NonCommercial 4.0 International (CC BY-NC 4.0)"
 
 from . import seqxml
 from . import impute2
+from . import impute2_binary
 from . import gtf
+from . import bgzf
 
 
 gff = gtf
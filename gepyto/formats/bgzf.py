@@ -0,0 +1,338 @@
+#
+# Implementation of a reader for the BGZF (blocked gzip) format.
+# See the SAM format specification (section 4.1) for more information on the
+# format: https://samtools.github.io/hts-specs/SAMv1.pdf
+#
+# This file is part of gepyto.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to Creative
+# Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+
+__author__ = "Marc-Andre Legault"
+__copyright__ = ("Copyright 2014 Marc-Andre Legault and Louis-Philippe "
+                 "Lemieux Perreault. All rights reserved.")
+__license__ = "Attribution-NonCommercial 4.0 International (CC BY-NC 4.0)"
+
+
+import struct
+import zlib
+
+
+# The fixed part of the header of a BGZF block (ID1, ID2, CM, FLG, MTIME, XFL,
+# OS, XLEN, SI1, SI2, SLEN and BSIZE).
+_HEADER = struct.Struct("<4BI2BH2BHH")
+_MAGIC = b"\x1f\x8b\x08\x04"
+_SUBFIELD = b"BC\x02\x00"
+
+# The empty block that marks the end of a BGZF file.
+EOF_BLOCK = (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02"
+             b"\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+
+
+def is_gzip(fn):
+    """Checks if a file is gzip compressed (BGZF or not).
+
+    :param fn: The filename.
+    :type fn: str
+
+    :rtype: bool
+
+    """
+    with open(fn, "rb") as f:
+        return f.read(2) == b"\x1f\x8b"
+
+
+def is_bgzf(fn):
+    """Checks if a file is BGZF compressed.
+
+    :param fn: The filename.
+    :type fn: str
+
+    :rtype: bool
+
+    """
+    with open(fn, "rb") as f:
+        header = f.read(_HEADER.size)
+
+    return _is_block_header(header)
+
+
+def _is_block_header(header):
+    return (len(header) == _HEADER.size and header[:4] == _MAGIC and
+            header[10:16] == b"\x06\x00" + _SUBFIELD)
+
+
+def make_virtual_offset(block_offset, within_block_offset):
+    """Computes a BGZF virtual offset.
+
+    :param block_offset: The position of the block in the compressed file.
+    :type block_offset: int
+
+    :param within_block_offset: The position in the uncompressed block.
+    :type within_block_offset: int
+
+    :rtype: int
+
+    """
+    return (block_offset << 16) | within_block_offset
+
+
+def split_virtual_offset(virtual_offset):
+    """Splits a BGZF virtual offset.
+
+    :param virtual_offset: The virtual offset.
+    :type virtual_offset: int
+
+    :returns: A tuple of the block offset and the offset in the block.
+    :rtype: tuple
+
+    """
+    return virtual_offset >> 16, virtual_offset & 0xffff
+
+
+def compress_block(data):
+    """Compresses data into a single BGZF block.
+
+    :param data: The data (at most 65280 bytes to make sure that the
+                 compressed block fits).
+    :type data: bytes
+
+    :returns: The BGZF block.
+    :rtype: bytes
+
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+
+    header = _HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+                          len(cdata) + 25)
+    footer = struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+    return header + cdata + footer
+
+
+class BgzfFile(object):
+    """Read a BGZF file as a text file with seekable virtual offsets.
+
+    :param fn: The filename of the BGZF compressed file.
+    :type fn: str
+
+    :param pread: A function to read ``size`` bytes at an ``offset`` of the
+                  compressed file (with the same signature as
+                  :py:func:`os.pread` without the file descriptor). This can
+                  be used to share a file descriptor between readers that
+                  have their own cursor. If it is not given, the file is
+                  opened.
+    :type pread: callable
+
+    The :py:func:`tell` and :py:func:`seek` methods use virtual offsets
+    (``block_offset << 16 | within_block_offset``). Seeking to a virtual
+    offset only decompresses the corresponding block. The first block is only
+    decompressed if it is read (i.e. not when the file is opened to seek
+    elsewhere).
+
+    This also implements the context manager and iterator interfaces.
+
+    """
+
+    def __init__(self, fn, pread=None):
+        self._filename = fn
+
+        if pread is None:
+            self._file = open(fn, "rb")
+            pread = self._file_pread
+        else:
+            self._file = None
+        self._pread = pread
+
+        if not _is_block_header(self._pread(_HEADER.size, 0)):
+            self.close()
+            raise Exception("File '{}' is not BGZF compressed.".format(fn))
+
+        # Statistics on the compression (from the loaded blocks).
+        self._compressed_bytes = 0
+        self._uncompressed_bytes = 0
+
+        # No block is loaded yet (the first one is loaded on the first read).
+        self._block_offset = 0
+        self._within = 0
+        self._data = None
+        self._next_block_offset = 0
+
+    @property
+    def compression_ratio(self):
+        """The ratio of compressed to uncompressed bytes (from the blocks
+        that were read so far).
+
+        """
+        if self._uncompressed_bytes == 0:
+            return 1.0
+        return self._compressed_bytes / float(self._uncompressed_bytes)
+
+    def _load_block(self, block_offset):
+        """Loads the first non-empty block at ``block_offset`` or after."""
+        while True:
+            self._block_offset = block_offset
+            self._within = 0
+
+            header = self._pread(_HEADER.size, block_offset)
+            if not header:
+                # End of file.
+                self._data = b""
+                self._next_block_offset = block_offset
+                return
+
+            if not _is_block_header(header):
+                raise Exception("Invalid BGZF block at offset {}.".format(
+                    block_offset
+                ))
+
+            block_size = _HEADER.unpack(header)[-1] + 1
+            cdata = self._pread(block_size - _HEADER.size - 8,
+                                block_offset + _HEADER.size)
+            self._data = zlib.decompress(cdata, -15)
+
+            self._next_block_offset = block_offset + block_size
+            self._compressed_bytes += block_size
+            self._uncompressed_bytes += len(self._data)
+
+            if self._data:
+                return
+
+            block_offset = self._next_block_offset
+
+    def seek(self, virtual_offset):
+        """Moves to the given virtual offset.
+
+        :param virtual_offset: The virtual offset (from :py:func:`tell`).
+        :type virtual_offset: int
+
+        """
+        block_offset, within = split_virtual_offset(int(virtual_offset))
+        if self._data is None or block_offset != self._block_offset:
+            self._load_block(block_offset)
+
+        self._within = within
+        if self._within >= len(self._data):
+            self._load_block(self._next_block_offset)
+
+    def seek_block(self, offset):
+        """Moves to the start of the first block at or after a position in
+        the compressed file.
+
+        :param offset: The position in the compressed file.
+        :type offset: int
+
+        """
+        chunk_size = 1 << 17
+        offset = int(offset)
+        while True:
+            chunk = self._pread(chunk_size + _HEADER.size, offset)
+            if len(chunk) < _HEADER.size:
+                # No more blocks.
+                self._load_block(offset + len(chunk))
+                return
+
+            i = chunk.find(_MAGIC)
+            while 0 <= i <= chunk_size:
+                if _is_block_header(chunk[i:i + _HEADER.size]):
+                    self._load_block(offset + i)
+                    return
+                i = chunk.find(_MAGIC, i + 1)
+
+            offset += chunk_size
+
+    def tell(self):
+        """Returns the current virtual offset."""
+        return make_virtual_offset(self._block_offset, self._within)
+
+    def raw_tell(self):
+        """Returns the position of the current block in the compressed
+        file.
+
+        """
+        return self._block_offset
+
+    def readline(self):
+        """Reads a single line (an empty string is returned at the end of
+        the file).
+
+        """
+        if self._data is None:
+            self._load_block(0)
+
+        chunks = []
+        while self._data:
+            i = self._data.find(b"\n", self._within)
+            if i == -1:
+                chunks.append(self._data[self._within:])
+                self._load_block(self._next_block_offset)
+                continue
+
+            chunks.append(self._data[self._within:i + 1])
+            self._within = i + 1
+            if self._within == len(self._data):
+                self._load_block(self._next_block_offset)
+            break
+
+        return b"".join(chunks).decode("utf-8")
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration()
+        return line
+
+    next = __next__
+
+    def __iter__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _file_pread(self, size, offset):
+        self._file.seek(offset)
+        return self._file.read(size)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def compress(fn, out_fn=None, block_size=0xff00):
+    """Compresses a file using BGZF.
+
+    :param fn: The filename of the file to compress.
+    :type fn: str
+
+    :param out_fn: The filename of the compressed file (defaults to the input
+                   filename with a ``.gz`` extension).
+    :type out_fn: str
+
+    :param block_size: The number of uncompressed bytes in every block.
+    :type block_size: int
+
+    :returns: The filename of the compressed file.
+    :rtype: str
+
+    """
+    assert 0 < block_size <= 0xff00
+
+    if out_fn is None:
+        out_fn = "{}.gz".format(fn)
+
+    with open(fn, "rb") as f, open(out_fn, "wb") as out:
+        data = f.read(block_size)
+        while data:
+            out.write(compress_block(data))
+            data = f.read(block_size)
+        out.write(EOF_BLOCK)
+
+    return out_fn
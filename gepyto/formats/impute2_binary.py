@@ -0,0 +1,593 @@
+#
+# A compact binary container for IMPUTE2 genotype probabilities.
+#
+# This file is part of gepyto.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to Creative
+# Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+from __future__ import division, print_function
+
+__author__ = "Louis-Philippe Lemieux Perreault"
+__copyright__ = ("Copyright 2014 Marc-Andre Legault and Louis-Philippe "
+                 "Lemieux Perreault. All rights reserved.")
+__license__ = "Attribution-NonCommercial 4.0 International (CC BY-NC 4.0)"
+
+import io
+import struct
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from ..db import index
+from .impute2 import (DOSAGE, LINE, HARD_CALL, Impute2File, SampleQC, _Line,
+                      _compute_block_dosage, _compute_dosage,
+                      _compute_filtered_dosage, _compute_hard_calls,
+                      _mode_arguments, _sample_indices, _variant_filter,
+                      _variant_records, _variant_stats, _variant_stats_table)
+
+
+# The header of the file (magic, version, bits per probability, number of
+# samples, number of variants, number of blocks and offset of the block
+# table).
+_HEADER = struct.Struct("<4sBBIQQQ")
+_MAGIC = b"GTPB"
+_VERSION = 1
+
+# The header of a block (number of variants, size of the variant information
+# and size of the compressed data).
+_BLOCK_HEADER = struct.Struct("<III")
+
+# The block table (offset of the block, index of its first variant and
+# number of variants).
+_BLOCK_DTYPE = np.dtype([("offset", "<u8"), ("first", "<u8"), ("n", "<u4")])
+
+# The type of the quantized probabilities.
+_DTYPES = {8: np.dtype("<u1"), 16: np.dtype("<u2")}
+
+
+def convert_impute2(fn, out_fn, bits=8, block_size=1000,
+                    compression_level=6):
+    """Converts an IMPUTE2 file to the binary format.
+
+    :param fn: The filename of the IMPUTE2 file.
+    :type fn: str
+
+    :param out_fn: The filename of the binary file.
+    :type out_fn: str
+
+    :param bits: The number of bits per probability (8 or 16).
+    :type bits: int
+
+    :param block_size: The number of variants per compressed block.
+    :type block_size: int
+
+    :param compression_level: The zlib compression level.
+    :type compression_level: int
+
+    :returns: The filename of the binary file.
+    :rtype: str
+
+    The three probabilities of every genotype are rounded to multiples of
+    ``1 / 255`` (8 bits) or ``1 / 65535`` (16 bits). They are all kept,
+    so missing genotypes (only zero probabilities) are preserved.
+
+    The file is made of blocks of ``block_size`` variants (the variant
+    information followed by the quantized probabilities, compressed using
+    zlib), followed by a table of the offsets of the blocks, a compressed
+    table of the regions of the blocks (chromosome, first and last positions,
+    for the random access) and a compressed table of all the variants.
+
+    """
+    if bits not in _DTYPES:
+        raise ValueError("Invalid number of bits ({}).".format(bits))
+    dtype = _DTYPES[bits]
+    max_code = 2 ** bits - 1
+
+    blocks = []
+    regions = []
+    variant_tables = []
+    n_samples = None
+    n_variants = 0
+    with Impute2File(fn) as f, open(out_fn, "wb") as out:
+        # The header is written at the end.
+        out.write(b"\0" * _HEADER.size)
+
+        for probabilities, variants in f.iter_blocks(block_size):
+            if n_samples is None:
+                n_samples = probabilities.shape[1]
+            elif probabilities.shape[1] != n_samples:
+                raise ValueError("Lines with different numbers of samples.")
+
+            info = "".join(
+                "{} {} {} {} {}\n".format(chrom, name, pos, a1, a2)
+                for name, chrom, pos, a1, a2 in variants.tolist()
+            ).encode("utf-8")
+            codes = np.rint(np.clip(probabilities, 0, 1) * max_code)
+            data = zlib.compress(info + codes.astype(dtype).tobytes(),
+                                 compression_level)
+
+            for chrom in sorted(set(variants.chrom.tolist())):
+                positions = variants.pos[variants.chrom == chrom]
+                regions.append("{} {} {} {}\n".format(
+                    len(blocks), chrom, positions.min(), positions.max(),
+                ))
+
+            blocks.append((out.tell(), n_variants, len(variants)))
+            out.write(_BLOCK_HEADER.pack(len(variants), len(info), len(data)))
+            out.write(data)
+
+            variant_tables.append(info)
+            n_variants += len(variants)
+
+        table_offset = out.tell()
+        out.write(np.array(blocks, dtype=_BLOCK_DTYPE).tobytes())
+
+        region_table = zlib.compress("".join(regions).encode("utf-8"),
+                                     compression_level)
+        out.write(struct.pack("<Q", len(region_table)))
+        out.write(region_table)
+
+        variant_table = zlib.compress(b"".join(variant_tables),
+                                      compression_level)
+        out.write(struct.pack("<Q", len(variant_table)))
+        out.write(variant_table)
+
+        out.seek(0)
+        out.write(_HEADER.pack(_MAGIC, _VERSION, bits, n_samples or 0,
+                               n_variants, len(blocks), table_offset))
+
+    return out_fn
+
+
+class BinaryImpute2File(object):
+    """Class representing a binary IMPUTE2 file (see
+    :py:func:`convert_impute2`).
+
+    :param fn: The filename of the binary file.
+    :type fn: str
+
+    :param mode: The reading mode (``line``, ``dosage`` or ``hard_call``).
+    :type mode: str
+
+    :param processes: Ignored (for compatibility with
+                      :py:class:`gepyto.formats.impute2.Impute2File`).
+    :type processes: int
+
+    :param block_size: Ignored (the blocks of the file are read at once).
+    :type block_size: int
+
+    :param samples: The selected samples (indices or a boolean mask).
+
+    This has the same reading modes, arguments and iteration interface as
+    :py:class:`gepyto.formats.impute2.Impute2File`, so it can replace it in
+    existing code. The probabilities are dequantized (they
+    differ from the text file by at most half a quantization step).
+
+    Usage: ::
+
+        convert_impute2("chr1.impute2", "chr1.gtpb", bits=16)
+
+        with BinaryImpute2File("chr1.gtpb", "dosage", min_maf=0.01) as f:
+            for dosage_vector, info in f:
+                pass
+
+            # Random access (using the block table).
+            lines = f.query(1, 1000000, 2000000)
+
+    """
+
+    def __init__(self, fn, mode=LINE, processes=1, block_size=1000,
+                 samples=None, **kwargs):
+        self._filename = fn
+        self._file = open(fn, "rb")
+
+        header = self._file.read(_HEADER.size)
+        if len(header) < _HEADER.size or header[:4] != _MAGIC:
+            self._file.close()
+            raise ValueError("File '{}' is not a binary IMPUTE2 "
+                             "file.".format(fn))
+
+        (_, version, bits, self.n_samples, self.n_variants, n_blocks,
+         table_offset) = _HEADER.unpack(header)
+        if version != _VERSION or bits not in _DTYPES:
+            self._file.close()
+            raise ValueError("Unsupported binary IMPUTE2 file (version {}, "
+                             "{} bits).".format(version, bits))
+        self.bits = bits
+        self._dtype = _DTYPES[bits]
+
+        self._file.seek(table_offset)
+        self._blocks = np.frombuffer(
+            self._file.read(n_blocks * _BLOCK_DTYPE.itemsize),
+            dtype=_BLOCK_DTYPE,
+        )
+
+        # The table of the regions of the blocks (read on the first query) is
+        # followed by the table of the variants.
+        size, = struct.unpack("<Q", self._file.read(8))
+        self._region_table = (self._file.tell(), size)
+        self._regions = None
+        self._variant_table_offset = self._region_table[0] + size
+        self._variants = None
+
+        self._samples = _sample_indices(samples)
+        if (self._samples is not None and len(self._samples) and
+                self._samples.max() >= self.n_samples):
+            self._file.close()
+            raise ValueError("Sample index {} is out of range (there are {} "
+                             "samples).".format(self._samples.max(),
+                                                self.n_samples))
+
+        assert mode in (DOSAGE, LINE, HARD_CALL)
+        self._mode = mode
+
+        # The special function arguments
+        try:
+            arguments = _mode_arguments(mode, kwargs)
+        except TypeError:
+            self._file.close()
+            raise
+        self.dosage_arguments = arguments[0]
+        self.dosage_filters = arguments[1]
+        self.hard_calls_arguments = arguments[2]
+
+        # The iteration (the current stored block and row).
+        self._block_size = 1
+        if len(self._blocks):
+            self._block_size = max(int(self._blocks["n"].max()), 1)
+        self._next_block = 0
+        self._block = None
+        self._row = 0
+        self._results = iter([])
+
+    @property
+    def variants(self):
+        """A DataFrame of the variants of the file (name, chrom, pos, a1 and
+        a2).
+
+        """
+        if self._variants is None:
+            self._file.seek(self._variant_table_offset)
+            size, = struct.unpack("<Q", self._file.read(8))
+            table = zlib.decompress(self._file.read(size))
+            self._variants = _variant_frame(table)
+        return self._variants
+
+    def _block_regions(self):
+        """The regions of the blocks (a DataFrame with the block, chrom,
+        start and end of every chromosome of every block).
+
+        """
+        if self._regions is None:
+            offset, size = self._region_table
+            self._file.seek(offset)
+            table = zlib.decompress(self._file.read(size))
+
+            columns = ["block", "chrom", "start", "end"]
+            if table:
+                regions = pd.read_csv(io.BytesIO(table), sep=" ",
+                                      header=None, names=columns,
+                                      dtype={"chrom": str},
+                                      keep_default_na=False)
+            else:
+                regions = pd.DataFrame({c: [] for c in columns})[columns]
+
+            # The chromosomes are compared without the "chr" prefix.
+            regions["query_chrom"] = [index._normalize_chrom(c)
+                                      for c in regions.chrom]
+            self._regions = regions
+
+        return self._regions
+
+    def read_stored_block(self, i):
+        """Reads a block of the file (as it was stored by
+        :py:func:`convert_impute2`).
+
+        :param i: The index of the stored block.
+        :type i: int
+
+        :returns: The probabilities (a ``variants x samples x 3`` array) and a
+                  record array of the variants (the same as
+                  :py:func:`gepyto.formats.impute2.Impute2File.read_block`).
+        :rtype: tuple
+
+        """
+        offset, first, n = self._blocks[i]
+        self._file.seek(int(offset))
+        n, info_size, size = _BLOCK_HEADER.unpack(
+            self._file.read(_BLOCK_HEADER.size)
+        )
+        data = zlib.decompress(self._file.read(size))
+
+        variants = _variant_frame(data[:info_size])
+        variants = _variant_records(list(zip(
+            variants.name, variants.chrom, variants.pos.tolist(), variants.a1,
+            variants.a2,
+        )))
+
+        codes = np.frombuffer(data, dtype=self._dtype, offset=info_size)
+        codes = codes.reshape(n, self.n_samples, 3)
+        if self._samples is not None:
+            codes = codes[:, self._samples]
+
+        return codes / (2 ** self.bits - 1), variants
+
+    def iter_stored_blocks(self):
+        """Iterate over the stored blocks of the file (see
+        :py:func:`read_stored_block`), from the start of the file.
+
+        :returns: A generator of blocks.
+        :rtype: generator
+
+        """
+        for i in range(len(self._blocks)):
+            yield self.read_stored_block(i)
+
+    def read_block(self, n=1000):
+        """Read (at most) ``n`` variants at once (see
+        :py:func:`gepyto.formats.impute2.Impute2File.read_block`).
+
+        :param n: The number of variants.
+        :type n: int
+
+        :returns: The probabilities (a ``variants x samples x 3`` array) and a
+                  numpy record array of the variants. Both are empty at the
+                  end of the file.
+        :rtype: tuple
+
+        This continues from the position of the iteration over the file
+        (the iteration decodes the variants by stored blocks, so it is after
+        the stored block of the last variant that was returned).
+
+        """
+        assert n > 0
+        blocks = []
+        n_read = 0
+        while n_read < n:
+            if self._block is None or self._row >= len(self._block[1]):
+                if self._next_block >= len(self._blocks):
+                    break
+                self._block = self.read_stored_block(self._next_block)
+                self._next_block += 1
+                self._row = 0
+
+            rows = slice(self._row, self._row + n - n_read)
+            blocks.append((self._block[0][rows], self._block[1][rows]))
+            n_read += len(blocks[-1][1])
+            self._row += len(blocks[-1][1])
+
+        if len(blocks) == 1:
+            return blocks[0]
+
+        if not blocks:
+            n_samples = (self.n_samples if self._samples is None
+                         else len(self._samples))
+            return np.empty((0, n_samples, 3)), _variant_records([])
+
+        return (
+            np.concatenate([probabilities for probabilities, _ in blocks]),
+            _variant_records([variant for _, variants in blocks
+                              for variant in variants.tolist()]),
+        )
+
+    def iter_blocks(self, n=1000):
+        """Iterate over the file by blocks of ``n`` variants.
+
+        :param n: The number of variants per block.
+        :type n: int
+
+        :returns: A generator of blocks (see :py:func:`read_block`).
+        :rtype: generator
+
+        """
+        while True:
+            probabilities, variants = self.read_block(n)
+            if len(variants) == 0:
+                return
+            yield probabilities, variants
+
+    def _decode_block(self, probabilities, variants):
+        """Decodes a block (according to the mode)."""
+        if self._mode is DOSAGE and self.dosage_filters:
+            return _compute_filtered_dosage(probabilities, variants,
+                                            self.dosage_filters,
+                                            **self.dosage_arguments)
+
+        results = []
+        for j, variant in enumerate(variants.tolist()):
+            line = _Line(*(variant + (probabilities[j], )))
+            if self._mode is DOSAGE:
+                line = _compute_dosage(line, **self.dosage_arguments)
+            elif self._mode is HARD_CALL:
+                line = _compute_hard_calls(line, **self.hard_calls_arguments)
+            results.append(line)
+        return results
+
+    def as_matrix(self):
+        """Creates a numpy dosage matrix from this file.
+
+        :returns: A numpy matrix where columns represent variant dosage
+                  between 0 and 2 and a dataframe describing the variants
+                  (major, minor, maf).
+        :type: tuple
+
+        The dosage is computed by blocks (using the ``prob_threshold`` and
+        the filters of the ``dosage`` mode).
+
+        .. warning::
+
+            This will load the whole dosage matrix in memory.
+
+        """
+        if self.dosage_arguments.get("is_chr23"):
+            raise NotImplementedError("dosage for chromosome 23 is not yet "
+                                      "supported")
+        prob_threshold = self.dosage_arguments.get("prob_threshold", 0)
+
+        matrices = []
+        infos = []
+        for probabilities, variants in self.iter_stored_blocks():
+            if self.dosage_filters:
+                keep = _variant_filter(probabilities, prob_threshold,
+                                       **self.dosage_filters)
+                probabilities = probabilities[keep]
+                variants = variants[keep]
+
+            dosage, info = _compute_block_dosage(probabilities, variants,
+                                                 prob_threshold)
+            matrices.append(dosage)
+            infos.append(pd.DataFrame(info))
+
+        n_samples = (self.n_samples if self._samples is None
+                     else len(self._samples))
+        if not matrices:
+            return np.empty((n_samples, 0)), pd.DataFrame()
+
+        return np.vstack(matrices).T, pd.concat(infos, ignore_index=True)
+
+    def variant_stats(self, prob_threshold=0.9, out_fn=None):
+        """Computes summary statistics for every variant in a single pass
+        (see :py:func:`gepyto.formats.impute2.Impute2File.variant_stats`).
+
+        :param prob_threshold: The genotype probability cutoff for the
+                               called genotypes.
+        :type prob_threshold: float
+
+        :param out_fn: The filename of the table of the statistics (tab
+                       separated), if it needs to be written.
+        :type out_fn: str
+
+        :returns: The statistics.
+        :rtype: :py:class:`pandas.DataFrame`
+
+        """
+        return _variant_stats_table(
+            (_variant_stats(probabilities, variants, prob_threshold)
+             for probabilities, variants in self.iter_blocks()),
+            out_fn,
+        )
+
+    def sample_qc(self, prob_threshold=0.9, f_variants=None):
+        """Computes the sample QC statistics in a single pass (see
+        :py:func:`gepyto.formats.impute2.Impute2File.sample_qc`).
+
+        :param prob_threshold: The genotype probability cutoff for the
+                               called genotypes.
+        :type prob_threshold: float
+
+        :param f_variants: The names of the variants used for the inbreeding
+                           coefficient (all the variants if ``None``).
+        :type f_variants: set
+
+        :returns: The accumulator.
+        :rtype: :py:class:`gepyto.formats.impute2.SampleQC`
+
+        """
+        n_samples = (self.n_samples if self._samples is None
+                     else len(self._samples))
+        qc = SampleQC(n_samples, prob_threshold, f_variants)
+        for probabilities, variants in self.iter_stored_blocks():
+            qc.update(probabilities, variants)
+        return qc
+
+    def query(self, chrom, start, end):
+        """Reads the variants of a region.
+
+        :param chrom: The chromosome.
+        :param start: The start of the region (inclusive).
+        :param end: The end of the region (inclusive).
+
+        :returns: A generator of the variants of the region (lines, dosage or
+                  hard calls, depending on the mode).
+        :rtype: generator
+
+        The blocks are found using the table of their regions, and only the
+        blocks overlapping the region are decompressed. This does not change
+        the position of the iteration over the file.
+
+        """
+        start = int(start)
+        end = int(end)
+
+        regions = self._block_regions()
+        regions = regions[
+            (regions.query_chrom.values == index._normalize_chrom(chrom)) &
+            (regions.start.values <= end) &
+            (regions.end.values >= start)
+        ]
+
+        for i in np.unique(regions.block.values):
+            probabilities, variants = self.read_stored_block(i)
+
+            in_region = (variants.pos >= start) & (variants.pos <= end)
+            in_chrom = np.zeros(len(variants), dtype=bool)
+            for block_chrom in set(regions.chrom[regions.block == i]):
+                in_chrom |= variants.chrom == block_chrom
+
+            rows = np.flatnonzero(in_region & in_chrom)
+            for result in self._decode_block(probabilities[rows],
+                                             variants[rows]):
+                yield result
+
+    def get(self, chrom, pos):
+        """Reads the variants at a position (see :py:func:`query`).
+
+        :param chrom: The chromosome.
+        :param pos: The position.
+
+        :returns: The variants at the position.
+        :rtype: list
+
+        """
+        return list(self.query(chrom, pos, pos))
+
+    def __next__(self):
+        while True:
+            for result in self._results:
+                return result
+
+            # The rest of the current stored block (or the next one).
+            probabilities, variants = self.read_block(self._block_size)
+            if len(variants) == 0:
+                raise StopIteration()
+            self._results = iter(self._decode_block(probabilities, variants))
+
+    next = __next__
+
+    def readline(self):
+        """Read a single variant (see :py:func:`__next__`)."""
+        return self.next()
+
+    def __iter__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def __repr__(self):
+        return "<BinaryImpute2File '{}' ({} samples x {} variants, {} " \
+               "bits)>".format(self._filename, self.n_samples,
+                               self.n_variants, self.bits)
+
+
+def _variant_frame(table):
+    """Parses a table of variants (``chrom name pos a1 a2`` lines)."""
+    columns = ["chrom", "name", "pos", "a1", "a2"]
+    if not table:
+        return pd.DataFrame({c: [] for c in columns})[["name", "chrom",
+                                                         "pos", "a1", "a2"]]
+
+    df = pd.read_csv(io.BytesIO(table), sep=" ", header=None, names=columns,
+                     dtype={"chrom": str, "name": str, "a1": str, "a2": str},
+                     keep_default_na=False)
+    return df[["name", "chrom", "pos", "a1", "a2"]]
@@ -12,12 +12,30 @@ __copyright__ = ("Copyright 2014 Marc-Andre Legault and Louis-Philippe "
                  "Lemieux Perreault. All rights reserved.")
 __license__ = "Attribution-NonCommercial 4.0 International (CC BY-NC 4.0)"
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 import unittest
 import string
 import random
+import gzip
 import os
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
 
-from ..db.index import build_index, get_index, goto, ChromosomeNotIndexed
+from ..db.index import (build_index, get_index, goto, query, find_loci,
+                        open_file, ChromosomeNotIndexed, INDEX_MAGIC,
+                        MAGIC_NUMBER, IndexedFile, index_cache_info,
+                        clear_index_cache, set_index_cache_size,
+                        INDEX_CACHE_MAX_BYTES, update_index,
+                        build_interval_index, query_overlaps, IntervalIndex,
+                        sort_and_index, build_manifest, IndexedFileSet,
+                        index_density, contig_density, shard_index)
+from ..db import index as index_module
+from ..formats import bgzf
 
 
 class TestIndex(unittest.TestCase):
@@ -72,6 +90,38 @@ class TestIndex(unittest.TestCase):
             line = TestIndex.f.readline().rstrip().split("\t")
             self.assertEqual(line[2], "1")
 
+    def test_index_per_contig(self):
+        build_index(TestIndex.fn, 0, 1, index_rate=1)
+        idx = get_index(TestIndex.fn)
+
+        self.assertEqual(idx.info["contigs"], ["1", "2", "3", "4", "5", "X",
+                                               "Y"])
+        self.assertEqual(list(idx.contig_starts), [0, 3, 7, 16, 17, 18, 19,
+                                                   20])
+        self.assertEqual(idx.contig_rows("chr3"), (7, 16))
+        self.assertEqual(list(idx.positions[7:16]), list(range(1, 10)))
+        self.assertEqual(idx.positions.dtype, np.uint32)
+
+        # Contigs longer than the old MAGIC_NUMBER.
+        fn = ".test_index_long_contig_gepyto.txt"
+        with open(fn, "w") as f:
+            for pos in (1, 10 ** 9, 3 * 10 ** 9, 5 * 10 ** 9):
+                f.write("scaffold_1\t{}\n".format(pos))
+            f.write("scaffold_2\t1\n")
+
+        try:
+            build_index(fn, 0, 1, index_rate=1)
+            idx = get_index(fn)
+            self.assertEqual(idx.positions.dtype, np.int64)
+            with open(fn, "r") as f:
+                self.assertTrue(goto(f, idx, "scaffold_1", 3 * 10 ** 9))
+                self.assertEqual(f.readline(), "scaffold_1\t3000000000\n")
+                self.assertFalse(goto(f, idx, "scaffold_1", 2))
+                self.assertTrue(goto(f, idx, "scaffold_2", 1))
+        finally:
+            os.remove(fn)
+            os.remove(fn + ".gtidx")
+
     def test_sparse_queries(self):
         build_index(TestIndex.fn, 0, 1, index_rate=0.9)
         idx = get_index(TestIndex.fn)
@@ -132,3 +182,843 @@ class TestIndex(unittest.TestCase):
 
             except ChromosomeNotIndexed:
                 pass
+
+    def test_parallel_build(self):
+        build_index(TestIndex.fn, 0, 1, index_rate=1)
+        _, serial_index = get_index(TestIndex.fn)
+
+        build_index(TestIndex.fn, 0, 1, index_rate=1, processes=3)
+        idx = get_index(TestIndex.fn)
+        self.assertTrue(np.array_equal(serial_index, idx[1]))
+
+        loci = TestIndex.positions
+        random.shuffle(loci)
+        for chrom, pos, _ in loci:
+            self.assertTrue(goto(TestIndex.f, idx, chrom, pos))
+            line = TestIndex.f.readline().rstrip().split("\t")
+            self.assertEqual(line[2], "1")
+
+    def test_parallel_build_unsorted(self):
+        fn = ".test_index_unsorted_gepyto.txt"
+        with open(fn, "w") as f:
+            for chrom in (1, 2, 1, 3):
+                for pos in range(1, 11):
+                    f.write("{}\t{}\t1\n".format(chrom, pos))
+
+        try:
+            self.assertRaises(Exception, build_index, fn, 0, 1, index_rate=1,
+                              processes=2)
+        finally:
+            os.remove(fn)
+            if os.path.isfile(fn + ".gtidx"):
+                os.remove(fn + ".gtidx")
+
+    def test_region_queries(self):
+        regions = [(1, 1, 100), (2, 11, 21), (3, 4, 8), (3, 0, 1000),
+                   ("chr3", 10, 20), ("Y", 1, 2), (5, 3, 4)]
+        for index_rate in (0.3, 1):
+            build_index(TestIndex.fn, 0, 1, index_rate=index_rate)
+            idx = get_index(TestIndex.fn)
+
+            for chrom, start, end in regions:
+                chrom = str(chrom).replace("chr", "")
+                expected = [
+                    (str(c).replace("chr", ""), p, str(v))
+                    for c, p, v in TestIndex.positions
+                    if str(c).replace("chr", "") == chrom and start <= p <= end
+                ]
+                observed = []
+                try:
+                    for line in query(TestIndex.f, idx, chrom, start, end):
+                        c, p, v = line.rstrip().split("\t")
+                        observed.append((c.replace("chr", ""), int(p), v))
+                except ChromosomeNotIndexed:
+                    # Sparse indices can miss small chromosomes.
+                    self.assertNotEqual(index_rate, 1)
+                    continue
+
+                self.assertEqual(sorted(expected, key=str),
+                                 sorted(observed, key=str))
+
+        self.assertRaises(ChromosomeNotIndexed, query, TestIndex.f, idx,
+                          "22", 1, 10)
+
+    def test_find_loci(self):
+        loci = [(chrom, pos) for chrom, pos, _ in TestIndex.positions]
+        loci += [(1, 0), ("X", 1), (3, 10), ("Y", 3), (2, 11), (1, 1)]
+        random.shuffle(loci)
+
+        for index_rate in (0.3, 1):
+            build_index(TestIndex.fn, 0, 1, index_rate=index_rate)
+            idx = get_index(TestIndex.fn)
+
+            # Sparse indices can miss small chromosomes.
+            queries = [
+                (chrom, pos) for chrom, pos in loci
+                if str(chrom).replace("chr", "") in idx[0]["chrom_codes"]
+            ]
+
+            offsets = find_loci(TestIndex.f, idx, queries)
+            self.assertEqual(len(offsets), len(queries))
+
+            for (chrom, pos), offset in zip(queries, offsets):
+                if goto(TestIndex.f, idx, chrom, pos):
+                    self.assertEqual(offset, TestIndex.f.tell())
+                else:
+                    self.assertEqual(offset, -1)
+
+    def test_binary_format(self):
+        build_index(TestIndex.fn, 0, 1, index_rate=1)
+        idx = get_index(TestIndex.fn)
+        self.assertTrue(isinstance(idx.positions, np.memmap))
+        self.assertTrue(isinstance(idx.offsets, np.memmap))
+
+        with open(TestIndex.fn + ".gtidx", "rb") as f:
+            self.assertEqual(f.read(len(INDEX_MAGIC)), INDEX_MAGIC)
+
+    def test_legacy_format(self):
+        build_index(TestIndex.fn, 0, 1, index_rate=1)
+        expected = get_index(TestIndex.fn)
+
+        # Write the index using the old pickle + numpy format (where the loci
+        # are encoded as chrom_code * MAGIC_NUMBER + pos).
+        contigs = expected.info["contigs"]
+        info = {"chrom_col": 0, "pos_col": 1, "delimiter": "\t",
+                "chrom_codes": dict(
+                    (chrom, i + 1) for i, chrom in enumerate(contigs)
+                )}
+        table = expected.contig_table
+        index = np.column_stack((
+            (table[:, 0] + 1) * MAGIC_NUMBER + table[:, 1], table[:, 2]
+        ))
+        self.assertTrue(np.array_equal(expected.table, index))
+
+        with open(TestIndex.fn + ".gtidx", "wb") as f:
+            f.write(pickle.dumps(info))
+            np.save(f, index)
+
+        idx = get_index(TestIndex.fn)
+        self.assertEqual(idx.info["contigs"], contigs)
+        self.assertTrue(np.array_equal(idx.contig_table, table))
+
+        for chrom, pos, _ in TestIndex.positions:
+            self.assertTrue(goto(TestIndex.f, idx, chrom, pos))
+
+    def test_indexed_file(self):
+        build_index(TestIndex.fn, 0, 1, index_rate=1)
+
+        with IndexedFile(TestIndex.fn) as f:
+            lines = f.get("chr2", 11)
+            self.assertEqual(
+                [l.rstrip().split("\t")[2] for l in lines],
+                ["1", "gibberish", "blablatidoo", "potatoes"]
+            )
+            self.assertEqual(f.get(2, 12), [])
+            self.assertEqual(len(list(f.query(3, 2, 6))), 6)
+
+            offsets = f.find_loci([("X", 3), (1, 11)])
+            self.assertEqual(f.readline(offsets[0]), "X\t3\t1\n")
+            self.assertEqual(f.readline(offsets[1]), "1\t11\t1\n")
+
+    def test_index_cache(self):
+        build_index(TestIndex.fn, 0, 1, index_rate=1)
+        clear_index_cache()
+
+        idx = get_index(TestIndex.fn)
+        self.assertTrue(get_index(TestIndex.fn) is idx)
+        self.assertTrue(get_index(TestIndex.fn) is idx)
+        info = index_cache_info()
+        self.assertEqual((info["hits"], info["misses"]), (2, 1))
+        self.assertEqual(info["entries"], 1)
+        self.assertEqual(info["bytes"], idx.nbytes)
+
+        # Bypassing the cache.
+        self.assertFalse(get_index(TestIndex.fn, use_cache=False) is idx)
+        self.assertEqual(index_cache_info()["hits"], 2)
+
+        # Rebuilding the index invalidates the cache entry.
+        build_index(TestIndex.fn, 0, 1, index_rate=0.5)
+        sparse_idx = get_index(TestIndex.fn)
+        self.assertFalse(sparse_idx is idx)
+        self.assertEqual(index_cache_info()["misses"], 2)
+
+        # Modifying the indexed file too.
+        os.utime(TestIndex.fn, (0, 0))
+        self.assertFalse(get_index(TestIndex.fn) is sparse_idx)
+        self.assertEqual(index_cache_info()["misses"], 3)
+
+        # The cache is bounded by the size of the arrays.
+        set_index_cache_size(0)
+        try:
+            get_index(TestIndex.fn)
+            self.assertEqual(index_cache_info()["entries"], 0)
+            self.assertEqual(index_cache_info()["bytes"], 0)
+        finally:
+            set_index_cache_size(INDEX_CACHE_MAX_BYTES)
+
+    def test_bloom_filter(self):
+        class UntouchedFile(object):
+            def __getattr__(self, name):
+                raise AssertionError("The file was read.")
+
+        absent = [(1, 0), (1, 2), (3, 10), ("Y", 3), (2, 12), (4, 4)]
+
+        for index_rate, processes in ((1, 1), (0.3, 1), (0.3, 2)):
+            build_index(TestIndex.fn, 0, 1, index_rate=index_rate,
+                        processes=processes, bloom=True, bloom_fp_rate=1e-6)
+            idx = get_index(TestIndex.fn)
+            self.assertTrue(idx.bloom is not None)
+
+            # No false negatives.
+            for chrom, pos, _ in TestIndex.positions:
+                self.assertTrue(idx.might_contain(chrom, pos))
+                if str(chrom).replace("chr", "") in idx.info["chrom_codes"]:
+                    self.assertTrue(goto(TestIndex.f, idx, chrom, pos))
+
+            # Absent loci don't read the file.
+            for chrom, pos in absent:
+                self.assertFalse(idx.might_contain(chrom, pos))
+                if str(chrom) in idx.info["chrom_codes"]:
+                    self.assertFalse(goto(UntouchedFile(), idx, chrom, pos))
+
+            loci = [(chrom, pos) for chrom, pos in absent
+                    if str(chrom) in idx.info["chrom_codes"]]
+            self.assertTrue(np.all(find_loci(UntouchedFile(), idx, loci) ==
+                                   -1))
+
+            with IndexedFile(TestIndex.fn) as f:
+                self.assertEqual(f.get(1, 2), [])
+                self.assertEqual(len(f.get(2, 11)), 4)
+
+    def test_bisection(self):
+        fn = ".test_index_bisection_gepyto.txt"
+        with open(fn, "w") as f:
+            for chrom in ("1", "2"):
+                for pos in range(1, 20001):
+                    f.write("{}\t{}\t1\n".format(chrom, pos))
+                    if pos % 7 == 0:
+                        f.write("{}\t{}\tduplicate\n".format(chrom, pos))
+
+        # Count the parsed lines.
+        calls = [0]
+        get_locus = index_module._get_locus
+
+        def counting_get_locus(*args, **kwargs):
+            calls[0] += 1
+            return get_locus(*args, **kwargs)
+
+        try:
+            build_index(fn, 0, 1, index_rate=0.001)
+            idx = get_index(fn)
+
+            index_module._get_locus = counting_get_locus
+            with open(fn, "r") as f:
+                for chrom, pos in [("1", 1), ("1", 7777), ("2", 14000),
+                                   ("2", 20000), ("1", 20000), ("2", 1)]:
+                    calls[0] = 0
+                    self.assertTrue(goto(f, idx, chrom, pos))
+                    self.assertEqual(f.readline(),
+                                     "{}\t{}\t1\n".format(chrom, pos))
+                    self.assertTrue(calls[0] < 100)
+
+                self.assertFalse(goto(f, idx, "1", 20001))
+                self.assertFalse(goto(f, idx, "2", 0))
+
+                calls[0] = 0
+                lines = list(query(f, idx, "2", 6999, 7001))
+                self.assertEqual(len(lines), 4)
+                self.assertTrue(calls[0] < 100)
+
+            with IndexedFile(fn) as f:
+                calls[0] = 0
+                self.assertEqual(len(f.get(1, 700)), 2)
+                self.assertTrue(calls[0] < 100)
+
+        finally:
+            index_module._get_locus = get_locus
+            os.remove(fn)
+            os.remove(fn + ".gtidx")
+
+
+class TestUpdateIndex(unittest.TestCase):
+    """Tests the incremental update of indices."""
+
+    def setUp(self):
+        self.fn = ".test_index_update_gepyto.txt"
+        self.lines = []
+        self.append([(1, pos) for pos in range(1, 200)])
+
+    def tearDown(self):
+        for fn in (self.fn, self.fn + ".gtidx", self.fn + ".gz",
+                   self.fn + ".gz.gtidx"):
+            if os.path.isfile(fn):
+                os.remove(fn)
+
+    def append(self, loci):
+        with open(self.fn, "a") as f:
+            for chrom, pos in loci:
+                line = "{}\t{}\t{}\n".format(chrom, pos, len(self.lines))
+                f.write(line)
+                self.lines.append(line)
+
+    def check(self, fn=None):
+        fn = self.fn if fn is None else fn
+        with IndexedFile(fn) as f:
+            for line in self.lines:
+                locus = line.split("\t")[:2]
+                expected = [
+                    l for l in self.lines if l.split("\t")[:2] == locus
+                ]
+                self.assertEqual(f.get(*locus), expected)
+
+    def test_update(self):
+        for index_rate in (1, 0.1):
+            self.lines = []
+            os.remove(self.fn)
+            self.append([(1, pos) for pos in range(1, 200)])
+
+            build_index(self.fn, 0, 1, index_rate=index_rate)
+            n = len(get_index(self.fn))
+
+            # Nothing to do.
+            update_index(self.fn)
+            self.assertEqual(len(get_index(self.fn)), n)
+
+            # Same locus as the last line, same and new chromosomes.
+            self.append([(1, 199), (1, 200), (1, 201)])
+            self.append([(2, pos) for pos in range(1, 100)])
+            update_index(self.fn)
+            self.assertTrue(len(get_index(self.fn)) > n)
+            self.assertEqual(get_index(self.fn).info["contigs"], ["1", "2"])
+
+            with open(self.fn, "r") as f:
+                self.assertTrue(goto(f, get_index(self.fn), 1, 199))
+                self.assertEqual(f.readline(), "1\t199\t198\n")
+
+            self.check()
+
+            # Rebuilding gives the same index (for the full index).
+            if index_rate == 1:
+                table = get_index(self.fn).contig_table
+                build_index(self.fn, 0, 1, index_rate=index_rate)
+                self.assertTrue(np.array_equal(
+                    get_index(self.fn).contig_table, table,
+                ))
+
+    def test_update_unsorted(self):
+        build_index(self.fn, 0, 1, index_rate=1)
+
+        self.append([(2, 1), (1, 300)])
+        self.assertRaises(Exception, update_index, self.fn)
+
+    def test_update_truncated(self):
+        build_index(self.fn, 0, 1, index_rate=1)
+
+        os.remove(self.fn)
+        self.lines = []
+        self.append([(1, 1)])
+        self.assertRaises(Exception, update_index, self.fn)
+
+    def test_update_bloom(self):
+        build_index(self.fn, 0, 1, index_rate=0.1, bloom=True)
+        self.append([(2, pos) for pos in range(1, 100)])
+        update_index(self.fn)
+
+        idx = get_index(self.fn)
+        self.assertTrue(idx.bloom is not None)
+        for pos in range(1, 100):
+            self.assertTrue(idx.might_contain(2, pos))
+        self.check()
+
+    def test_update_bgzf(self):
+        bgzf.compress(self.fn, block_size=300)
+        build_index(self.fn + ".gz", 0, 1, index_rate=0.1)
+
+        # Concatenating BGZF files is a valid way to append.
+        size = os.path.getsize(self.fn)
+        self.append([(3, pos) for pos in range(1, 100)])
+        with open(self.fn, "rb") as f:
+            f.seek(size)
+            tail = f.read()
+
+        with open(self.fn + ".gz", "ab") as f:
+            f.write(bgzf.compress_block(tail))
+            f.write(bgzf.EOF_BLOCK)
+
+        update_index(self.fn + ".gz")
+        self.assertEqual(get_index(self.fn + ".gz").info["contigs"],
+                         ["1", "3"])
+        self.check(self.fn + ".gz")
+
+
+class TestSortAndIndex(unittest.TestCase):
+    """Tests the external sort of unsorted files."""
+
+    def setUp(self):
+        self.fn = ".test_sort_gepyto.txt"
+        self.out_fn = ".test_sort_gepyto.sorted.txt"
+
+        chroms = ["chr1", "2", "10", "X", "Y", "MT", "contig_b", "contig_a"]
+        self.lines = []
+        for i in range(500):
+            chrom = random.choice(chroms)
+            pos = random.randint(1, 100)
+            self.lines.append("{}\t{}\t{}\n".format(chrom, pos, i))
+
+        with open(self.fn, "w") as f:
+            f.write("#chrom\tpos\tline\n")
+            f.writelines(self.lines)
+
+    def tearDown(self):
+        for fn in (self.fn, self.out_fn, self.out_fn + ".gtidx"):
+            if os.path.isfile(fn):
+                os.remove(fn)
+
+    def expected(self):
+        order = {"1": 0, "2": 1, "10": 2, "X": 3, "Y": 4, "MT": 5,
+                 "contig_a": 6, "contig_b": 7}
+
+        def key(line):
+            chrom, pos, _ = line.split("\t")
+            if chrom.startswith("chr"):
+                chrom = chrom[3:]
+            return order[chrom], int(pos)
+
+        return ["#chrom\tpos\tline\n"] + sorted(self.lines, key=key)
+
+    def test_sort(self):
+        for processes in (1, 2):
+            sort_and_index(self.fn, self.out_fn, 0, 1, ignore_startswith="#",
+                           index_rate=1, processes=processes,
+                           buffer_size=512)
+
+            with open(self.out_fn, "r") as f:
+                self.assertEqual(f.readlines(), self.expected())
+
+            idx = get_index(self.out_fn)
+            self.assertEqual(idx.info["contigs"],
+                             ["1", "2", "10", "X", "Y", "MT", "contig_a",
+                              "contig_b"])
+
+            # The index is the same as the one built from the sorted file.
+            build_index(self.out_fn, 0, 1, index_rate=1,
+                        ignore_startswith="#")
+            rebuilt = get_index(self.out_fn)
+            self.assertEqual(list(idx.positions), list(rebuilt.positions))
+            self.assertEqual(list(idx.offsets), list(rebuilt.offsets))
+
+            with open(self.out_fn, "r") as f:
+                for line in self.lines:
+                    chrom, pos, _ = line.split("\t")
+                    self.assertTrue(goto(f, idx, chrom, int(pos)))
+                    self.assertEqual(f.readline().split("\t")[:2],
+                                     [chrom, pos])
+
+    def test_sparse_bloom(self):
+        sort_and_index(self.fn, self.out_fn, 0, 1, ignore_startswith="#",
+                       index_rate=0.2, buffer_size=1024, bloom=True)
+
+        idx = get_index(self.out_fn)
+        self.assertTrue(len(idx) < len(self.lines))
+        self.assertIsNotNone(idx.info["seek_jump"])
+
+        with open(self.out_fn, "r") as f:
+            for line in self.lines:
+                chrom, pos, _ = line.split("\t")
+                self.assertTrue(idx.might_contain(chrom, int(pos)))
+                self.assertTrue(goto(f, idx, chrom, int(pos)))
+
+
+class TestIndexedFileSet(unittest.TestCase):
+    """Tests the manifest of a set of (per chromosome or chunk) files."""
+
+    def setUp(self):
+        # Chromosome 1 is split in two chunks.
+        self.files = {
+            ".test_set_gepyto_1a.txt": [("1", pos) for pos in range(1, 51)],
+            ".test_set_gepyto_1b.txt": [("1", pos) for pos in range(51, 101)],
+            ".test_set_gepyto_2.txt": [("2", pos) for pos in range(1, 101)],
+            ".test_set_gepyto_34.txt": ([("3", pos) for pos in range(1, 4)] +
+                                        [("4", pos) for pos in range(1, 4)]),
+        }
+        for fn, loci in self.files.items():
+            with open(fn, "w") as f:
+                for chrom, pos in loci:
+                    f.write("chr{}\t{}\t{}_{}\n".format(chrom, pos, fn,
+                                                         pos))
+
+        self.manifest_fn = ".test_set_gepyto.json"
+        build_manifest(self.manifest_fn, sorted(self.files.keys()), 0, 1,
+                       index_rate=1)
+
+    def tearDown(self):
+        for fn in self.files:
+            os.remove(fn)
+            os.remove(fn + ".gtidx")
+        os.remove(self.manifest_fn)
+
+    def test_routing(self):
+        with IndexedFileSet(self.manifest_fn) as f:
+            self.assertEqual(sorted(f.contigs), ["1", "2", "3", "4"])
+            self.assertEqual(
+                [os.path.basename(fn) for fn in f.files_for("chr1", 10)],
+                [".test_set_gepyto_1a.txt"]
+            )
+            self.assertEqual(
+                [os.path.basename(fn) for fn in f.files_for(1, 40, 60)],
+                [".test_set_gepyto_1a.txt", ".test_set_gepyto_1b.txt"]
+            )
+            self.assertEqual(f.files_for(1, 101), [])
+            self.assertEqual(f.files_for("X", 1), [])
+
+    def test_queries(self):
+        with IndexedFileSet(self.manifest_fn, max_open_files=1) as f:
+            for fn, loci in self.files.items():
+                for chrom, pos in loci:
+                    lines = f.get(chrom, pos)
+                    self.assertEqual(len(lines), 1)
+                    self.assertEqual(lines[0].rstrip().split("\t")[2],
+                                     "{}_{}".format(fn, pos))
+
+            self.assertEqual(f.get(1, 101), [])
+            self.assertEqual(f.get("X", 1), [])
+
+            # A region across the two chunks (interleaved with other queries
+            # so that the files are reopened).
+            region = f.query("chr1", 45, 55)
+            self.assertEqual(next(region).split("\t")[1], "45")
+            self.assertEqual(len(f.get(2, 10)), 1)
+            self.assertEqual([line.split("\t")[1] for line in region],
+                             [str(pos) for pos in range(46, 56)])
+            self.assertTrue(len(f._handles) <= 2)
+
+    def test_sparse_index(self):
+        # A large contig followed by a small one, indexed at a low rate.
+        fn = ".test_set_gepyto_mt.txt"
+        with open(fn, "w") as f:
+            for chrom, n_lines in (("Y", 5000), ("MT", 3)):
+                for pos in range(1, n_lines + 1):
+                    f.write("{}\t{}\t{}_{}\n".format(chrom, pos, chrom, pos))
+
+        manifest_fn = ".test_set_gepyto_sparse.json"
+        try:
+            build_manifest(manifest_fn, [fn], 0, 1, index_rate=0.01)
+            with IndexedFileSet(manifest_fn) as f:
+                self.assertEqual(sorted(f.contigs), ["MT", "Y"])
+                self.assertEqual(
+                    [line.split("\t")[1] for line in f.query("MT", 2, 10)],
+                    ["2", "3"]
+                )
+                self.assertEqual(f.files_for("MT", 4), [])
+                self.assertEqual(len(f.get("Y", 4321)), 1)
+
+        finally:
+            for name in (fn, fn + ".gtidx", manifest_fn):
+                if os.path.isfile(name):
+                    os.remove(name)
+
+
+class TestDensity(unittest.TestCase):
+    """Tests the density statistics and the sharding (from the index)."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fn = ".test_density_gepyto.txt"
+        cls.n_lines = {"1": 3000, "2": 1000, "3": 10}
+        with open(cls.fn, "w") as f:
+            for chrom in ("1", "2", "3"):
+                for i in range(cls.n_lines[chrom]):
+                    # The lines have the same length.
+                    f.write("{}\t{}\tACGT\n".format(chrom,
+                                                     10 ** 6 + 1000 * i))
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.fn)
+        os.remove(cls.fn + ".gtidx")
+
+    def test_density(self):
+        for index_rate in (1, 0.1):
+            build_index(self.fn, 0, 1, index_rate=index_rate)
+            idx = get_index(self.fn)
+
+            df = contig_density(idx)
+            self.assertEqual(list(df["chrom"]), ["1", "2", "3"])
+            self.assertEqual(df["n_bytes"].sum(), os.path.getsize(self.fn))
+            self.assertAlmostEqual(
+                df["n_records"].sum() / sum(self.n_lines.values()), 1,
+                delta=0.01
+            )
+
+            # The lines of small contigs can be before the first indexed row
+            # of the contig (in sparse mode).
+            for chrom, n in zip(df["chrom"][:2], df["n_records"][:2]):
+                self.assertAlmostEqual(n / self.n_lines[chrom], 1, delta=0.1)
+
+            # 1000 records per Mb.
+            df = index_density(idx, bin_size=500000)
+            df = df[df["chrom"] == "1"]
+            self.assertEqual(list(df["start"]), [1000000, 1500000, 2000000,
+                                                 2500000, 3000000, 3500000])
+            for n in df["records_per_mb"]:
+                self.assertAlmostEqual(n / 1000.0, 1, delta=0.25)
+
+    def test_shards(self):
+        build_index(self.fn, 0, 1, index_rate=1)
+        idx = get_index(self.fn)
+
+        shards = shard_index(idx, 9)
+        self.assertEqual([shard[0] for shard in shards],
+                         ["1"] * 6 + ["2"] * 2 + ["3"])
+        self.assertEqual(shards[0][3], 0)
+        self.assertEqual(shards[-1][4], os.path.getsize(self.fn))
+
+        with open(self.fn, "r") as f:
+            n_lines = 0
+            for i, (chrom, start, end, byte_start, byte_end) in \
+                    enumerate(shards):
+                if i > 0:
+                    self.assertEqual(byte_start, shards[i - 1][4])
+
+                # The byte range and the region have the same lines.
+                f.seek(byte_start)
+                lines = []
+                while f.tell() < byte_end:
+                    lines.append(f.readline())
+
+                region = list(query(f, idx, chrom, start or 0,
+                                    end or 10 ** 9))
+                self.assertEqual(lines, region)
+                n_lines += len(lines)
+
+                if chrom != "3":
+                    self.assertAlmostEqual(len(lines) / 500.0, 1, delta=0.05)
+
+        self.assertEqual(n_lines, sum(self.n_lines.values()))
+
+    def test_more_shards_than_rows(self):
+        for index_rate in (1, 0.01):
+            build_index(self.fn, 0, 1, index_rate=index_rate)
+            idx = get_index(self.fn)
+
+            shards = shard_index(idx, 10 * len(idx))
+            self.assertTrue(len(shards) <= len(idx))
+            self.assertEqual(
+                sorted(set(shard[0] for shard in shards)),
+                idx.info["contigs"]
+            )
+
+            # The shards are contiguous and don't overlap.
+            self.assertEqual(shards[0][3], 0)
+            self.assertEqual(shards[-1][4], os.path.getsize(self.fn))
+            for i in range(1, len(shards)):
+                self.assertEqual(shards[i][3], shards[i - 1][4])
+                self.assertTrue(shards[i][3] < shards[i][4])
+
+
+class TestIntervalIndex(unittest.TestCase):
+    """Tests the interval index."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fn = ".test_interval_index_gepyto.bed"
+        random.seed(42)
+
+        cls.intervals = []
+        for i in range(500):
+            chrom = random.choice(["1", "2", "X"])
+            start = random.randint(0, 100000)
+            # Mostly short features, but also some very long ones.
+            if random.random() < 0.05:
+                end = start + random.randint(0, 80000)
+            else:
+                end = start + random.randint(0, 500)
+            cls.intervals.append((chrom, start, end, "feature_{}".format(i)))
+
+        # Some identical and nested intervals.
+        cls.intervals += [("1", 10, 20, "a"), ("1", 10, 20, "b"),
+                          ("1", 5, 100, "c"), ("1", 10, 15, "d")]
+
+        with open(cls.fn, "w") as f:
+            f.write("track name=test\n")
+            for interval in cls.intervals:
+                f.write("chr{}\t{}\t{}\t{}\n".format(*interval))
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.fn)
+        os.remove(cls.fn + ".gtidx")
+
+    def expected(self, chrom, start, end):
+        return sorted(
+            name for c, s, e, name in self.intervals
+            if c == chrom and s <= end and e >= start
+        )
+
+    def test_overlaps(self):
+        build_interval_index(self.fn, 0, 1, 2, skip_lines=1)
+        idx = get_index(self.fn)
+        self.assertTrue(isinstance(idx, IntervalIndex))
+        self.assertEqual(len(idx), len(self.intervals))
+
+        queries = [("1", 12, 12), ("1", 0, 9), ("2", 50000, 50100),
+                   ("X", 0, 1000000), ("X", 200000, 300000), ("1", 21, 21)]
+        for i in range(100):
+            start = random.randint(0, 110000)
+            queries.append((random.choice(["1", "2", "X"]), start,
+                            start + random.randint(0, 2000)))
+
+        with open(self.fn, "r") as f:
+            for chrom, start, end in queries:
+                observed = sorted(
+                    line.rstrip().split("\t")[3]
+                    for line in query_overlaps(f, idx, chrom, start, end)
+                )
+                self.assertEqual(observed, self.expected(chrom, start, end))
+
+        with IndexedFile(self.fn) as f:
+            lines = list(f.overlaps("chr1", 12, 12))
+            self.assertEqual(sorted(l.rstrip().split("\t")[3] for l in lines),
+                             self.expected("1", 12, 12))
+
+        self.assertRaises(ChromosomeNotIndexed, query_overlaps, None, idx,
+                          "Y", 1, 2)
+
+
+class TestBgzfIndex(unittest.TestCase):
+    """Tests the indexing of BGZF compressed files."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fn = ".test_index_bgzf_gepyto.txt"
+        cls.lines = []
+        with open(cls.fn, "w") as f:
+            for chrom in ("1", "2", "10", "X"):
+                for pos in range(1, 3000, 7):
+                    line = "{}\t{}\tsome_data_{}\n".format(chrom, pos, pos)
+                    f.write(line)
+                    cls.lines.append(line)
+
+        # Small blocks so that lines overlap blocks.
+        cls.bgzf_fn = bgzf.compress(cls.fn, block_size=500)
+
+    @classmethod
+    def tearDownClass(cls):
+        for fn in (cls.fn, cls.fn + ".gtidx", cls.bgzf_fn,
+                   cls.bgzf_fn + ".gtidx"):
+            if os.path.isfile(fn):
+                os.remove(fn)
+
+    def test_goto(self):
+        for index_rate, processes in ((1, 1), (0.05, 1), (0.05, 3)):
+            build_index(self.bgzf_fn, 0, 1, index_rate=index_rate,
+                        processes=processes)
+            idx = get_index(self.bgzf_fn)
+            self.assertEqual(idx[0]["compression"], "bgzf")
+
+            with open_file(self.bgzf_fn) as f:
+                self.assertTrue(isinstance(f, bgzf.BgzfFile))
+                for line in self.lines[::37]:
+                    chrom, pos, _ = line.split("\t")
+                    self.assertTrue(goto(f, idx, chrom, pos))
+                    self.assertEqual(f.readline(), line)
+
+                self.assertFalse(goto(f, idx, "2", 2))
+
+    def test_query(self):
+        build_index(self.bgzf_fn, 0, 1, index_rate=0.05)
+        idx = get_index(self.bgzf_fn)
+
+        expected = [l for l in self.lines
+                    if l.startswith("10\t") and
+                    100 <= int(l.split("\t")[1]) <= 1000]
+        with open_file(self.bgzf_fn) as f:
+            self.assertEqual(list(query(f, idx, "10", 100, 1000)), expected)
+
+    def test_find_loci(self):
+        build_index(self.bgzf_fn, 0, 1, index_rate=0.05)
+        idx = get_index(self.bgzf_fn)
+
+        loci = [tuple(l.split("\t")[:2]) for l in self.lines[::11]]
+        loci.append(("1", 2))
+        random.shuffle(loci)
+
+        with open_file(self.bgzf_fn) as f:
+            offsets = find_loci(f, idx, loci)
+            for (chrom, pos), offset in zip(loci, offsets):
+                if pos == 2:
+                    self.assertEqual(offset, -1)
+                    continue
+
+                f.seek(offset)
+                line = f.readline().split("\t")
+                self.assertEqual((line[0], line[1]), (chrom, pos))
+
+    def test_sparse_density(self):
+        fn = ".test_index_density_gepyto.txt"
+        with open(fn, "w") as f:
+            for chrom in ("1", "2", "3", "Y", "MT"):
+                n_lines = 5 if chrom in ("Y", "MT") else 3000
+                for pos in range(1, n_lines + 1):
+                    f.write("{}\t{}\t{}\n".format(chrom, pos,
+                                                   "A" * (pos % 50)))
+
+        # The default blocks contain many lines.
+        bgzf_fn = bgzf.compress(fn)
+
+        try:
+            for index_rate, bloom in ((0.2, False), (0.01, False),
+                                      (0.01, True)):
+                indices = []
+                for indexed_fn in (fn, bgzf_fn):
+                    build_index(indexed_fn, 0, 1, index_rate=index_rate,
+                                bloom=bloom)
+                    indices.append(get_index(indexed_fn))
+
+                plain, compressed = indices
+                self.assertEqual(compressed.info["contigs"],
+                                 ["1", "2", "3", "Y", "MT"])
+                self.assertEqual(compressed.info["contigs"],
+                                 plain.info["contigs"])
+                self.assertAlmostEqual(len(compressed) / float(len(plain)), 1,
+                                       delta=0.25)
+
+                with open_file(bgzf_fn) as f:
+                    self.assertTrue(goto(f, compressed, "MT", 3))
+                    self.assertEqual(f.readline().split("\t")[:2],
+                                     ["MT", "3"])
+
+        finally:
+            for name in (fn, bgzf_fn):
+                for suffix in ("", ".gtidx"):
+                    if os.path.isfile(name + suffix):
+                        os.remove(name + suffix)
+
+    def test_plain_gzip(self):
+        fn = ".test_index_gzip_gepyto.txt.gz"
+        with gzip.open(fn, "wb") as f:
+            f.write(b"1\t1\tA\n")
+
+        try:
+            self.assertRaises(Exception, build_index, fn, 0, 1)
+        finally:
+            os.remove(fn)
+
+    def test_concurrent_lookups(self):
+        loci = [tuple(l.split("\t")[:2]) for l in self.lines]
+        random.shuffle(loci)
+
+        for fn in (self.fn, self.bgzf_fn):
+            build_index(fn, 0, 1, index_rate=0.05)
+
+            with IndexedFile(fn) as f:
+                pool = ThreadPool(8)
+                try:
+                    results = pool.map(lambda l: f.get(*l), loci)
+                finally:
+                    pool.close()
+                    pool.join()
+
+            for (chrom, pos), lines in zip(loci, results):
+                self.assertEqual(len(lines), 1)
+                self.assertEqual(lines[0].split("\t")[:2], [chrom, pos])
@@ -14,13 +14,16 @@ __license__ = "Attribution-NonCommercial 4.0 International (CC BY-NC 4.0)"
 
 
 import os
+import math
 import datetime
 import unittest
 import tempfile
+import gzip
 
 import numpy as np
 
 from ..formats import impute2
+from ..formats import impute2_binary
 from .. import formats as fmts
 from ..structures.sequences import Sequence
 
@@ -335,6 +338,613 @@ class TestImpute2Class(unittest.TestCase):
                 else:
                     raise Exception()
 
+    def test_read_block(self):
+        """Test the block reader (compared to the line reader)."""
+        expected = [self.prob_snp1, self.prob_snp2, self.prob_indel]
+
+        with impute2.Impute2File(self.f.name) as f:
+            probabilities, variants = f.read_block(2)
+            self.assertEqual(probabilities.shape, (2, 3, 3))
+            self.assertEqual(len(variants), 2)
+
+            probabilities, variants = f.read_block(2)
+            self.assertEqual(probabilities.shape, (1, 3, 3))
+            self.assertEqual(variants[0].name, "rs23457")
+
+            probabilities, variants = f.read_block(2)
+            self.assertEqual(len(probabilities), 0)
+            self.assertEqual(len(variants), 0)
+
+        with impute2.Impute2File(self.f.name) as f:
+            blocks = list(f.iter_blocks(2))
+        self.assertEqual(len(blocks), 2)
+
+        probabilities = np.concatenate([b[0] for b in blocks])
+        variants = np.concatenate([b[1] for b in blocks])
+        for i, line in enumerate(expected):
+            self.assertEqual(tuple(variants[i]), line[:5])
+            self.assertTrue((probabilities[i] == line[5]).all())
+
+    def test_parallel(self):
+        """Test the parallel decoding (compared to the sequential one)."""
+        for mode, kwargs in (("line", {}), ("dosage", {}),
+                             ("dosage", {"prob_threshold": 0.9}),
+                             ("hard_call", {"prob_threshold": 0.9})):
+            with impute2.Impute2File(self.f.name, mode, **kwargs) as f:
+                expected = list(f)
+
+            with impute2.Impute2File(self.f.name, mode, processes=2,
+                                     block_size=1, **kwargs) as f:
+                results = list(f)
+
+            self.assertEqual(len(results), len(expected))
+            for result, line in zip(results, expected):
+                if mode == "line":
+                    self.assertTrue(compare_lines(result, line))
+                else:
+                    self.assertTrue(compare_dosages(self, line, result))
+
+        with impute2.Impute2File(self.f.name, processes=2,
+                                 block_size=2) as f:
+            m, df = f.as_matrix()
+        self.assertEqual(m.shape, (3, 3))
+        self.assertEqual(list(df["name"]), ["rs12345", "rs23456", "rs23457"])
+
+        # Errors in the workers are raised.
+        with tempfile.NamedTemporaryFile("w") as f:
+            f.write("1 rs1 1 A G 1 0 0\n1 rs2 2 C T 1 0\n")
+            f.flush()
+            with impute2.Impute2File(f.name, processes=2) as i2:
+                self.assertRaises(Exception, list, i2)
+
+    def test_read_block_fallback(self):
+        """Test the block reader with tokens that need to be parsed one by
+        one (scientific notation and long tokens).
+
+        """
+        with tempfile.NamedTemporaryFile("w") as f:
+            f.write("1 rs1 1 A G 1e-3 0.999 0 0 0 1\n"
+                    "1 rs2 2 C T 0.1234567 0.8765433 0 1 0 0\n")
+            f.flush()
+
+            with impute2.Impute2File(f.name) as i2:
+                probabilities, variants = i2.read_block(10)
+
+        self.assertEqual(list(variants.name), ["rs1", "rs2"])
+        self.assertTrue(compare_vectors(
+            probabilities,
+            [[[0.001, 0.999, 0], [0, 0, 1]],
+             [[0.1234567, 0.8765433, 0], [1, 0, 0]]],
+        ))
+
+    def test_read_block_tokens(self):
+        """Test the block reader with tokens of 1 to 6 characters."""
+        tokens = [["1", "0", "0"], ["0.5", ".25", "0.25"],
+                  ["0.001", "0.999", "0"], ["0.0625", "0.9375", "1."]]
+        with tempfile.NamedTemporaryFile("w") as f:
+            for i, probabilities in enumerate(tokens):
+                f.write("1 rs{} {} A G {}\n".format(
+                    i, i + 1, " ".join(probabilities * 2)
+                ))
+            f.flush()
+
+            with impute2.Impute2File(f.name) as i2:
+                probabilities, _ = i2.read_block(10)
+
+        for values, expected in zip(probabilities, tokens):
+            expected = [float(token) for token in expected]
+            self.assertEqual(values.tolist(), [expected] * 2)
+
+    def test_dosage_store(self):
+        """Test the out of core dosage store (compared to as_matrix)."""
+        with impute2.Impute2File(self.f.name, "dosage",
+                                 prob_threshold=0.9) as f:
+            expected, expected_df = f.as_matrix()
+
+        tmp_dir = tempfile.mkdtemp()
+        prefix = os.path.join(tmp_dir, "store")
+        try:
+            for dtype, tolerance in (("float32", 1e-6), ("uint8", 1 / 127),
+                                     ("uint16", 1 / 32767)):
+                for layout in ("sample", "variant"):
+                    with impute2.Impute2File(self.f.name, "dosage",
+                                             prob_threshold=0.9) as f:
+                        store = f.to_dosage_store(prefix, dtype=dtype,
+                                                  layout=layout,
+                                                  block_size=2)
+
+                    self.assertEqual(store.n_samples, 3)
+                    self.assertEqual(store.n_variants, 3)
+                    self.assertEqual(store.matrix.dtype, np.dtype(dtype))
+                    for col in ("name", "chrom", "pos", "major", "minor"):
+                        self.assertEqual(list(store.variants[col]),
+                                         list(expected_df[col]))
+                    self.assertTrue(np.allclose(store.variants.maf,
+                                                expected_df.maf))
+
+                    m = store.dosage()
+                    self.assertEqual(m.shape, expected.shape)
+                    self.assertTrue(
+                        (np.isnan(m) == np.isnan(expected)).all()
+                    )
+                    self.assertTrue(np.nanmax(np.abs(m - expected)) <=
+                                    tolerance)
+
+                    # Reading a subset of the variants.
+                    m = impute2.DosageStore(prefix).dosage(
+                        store.variants.name != "rs23456"
+                    )
+                    self.assertEqual(m.shape, (3, 2))
+                    self.assertTrue(np.allclose(m[:, 1], expected[:, 2],
+                                                atol=tolerance,
+                                                equal_nan=True))
+
+            # Chromosome 23 isn't supported (as for the iteration).
+            with impute2.Impute2File(self.f.name, "dosage",
+                                     is_chr23=True) as f:
+                self.assertRaises(NotImplementedError, f.to_dosage_store,
+                                  prefix)
+
+        finally:
+            for ext in (".dosage", ".json", ".variants.txt"):
+                os.remove(prefix + ext)
+            os.rmdir(tmp_dir)
+
+    def test_samples(self):
+        """Test the selection of the samples (at parse time)."""
+        for samples in ([2, 0], np.array([True, False, True])):
+            columns = [2, 0] if isinstance(samples, list) else [0, 2]
+
+            with impute2.Impute2File(self.f.name, samples=samples) as f:
+                lines = list(f)
+            for line, expected in zip(lines, (self.prob_snp1, self.prob_snp2,
+                                              self.prob_indel)):
+                self.assertTrue(compare_lines(
+                    line, expected[:5] + (expected[5][columns], ),
+                ))
+
+            with impute2.Impute2File(self.f.name, samples=samples) as f:
+                probabilities, variants = f.read_block(10)
+            self.assertEqual(probabilities.shape, (3, 2, 3))
+            for i, line in enumerate(lines):
+                self.assertTrue((probabilities[i] == line[5]).all())
+
+            with impute2.Impute2File(self.f.name, "dosage",
+                                     samples=samples) as f:
+                result = next(f)
+            self.assertAlmostEqual(result[1]["maf"], 1.003 / 4)
+            self.assertTrue(compare_vectors(result[0],
+                                            self.dosage_snp1[0][columns]))
+
+        with impute2.Impute2File(self.f.name, "hard_call", processes=2,
+                                 block_size=1, samples=[1]) as f:
+            results = list(f)
+        self.assertEqual([list(r[0]) for r in results],
+                         [["A A"], ["T T"], ["T TC"]])
+
+        # The fallback parser (scientific notation) and empty selections.
+        with tempfile.NamedTemporaryFile("w") as f:
+            f.write("1 rs1 1 A G 1e-3 0.999 0 0 0 1\n")
+            f.flush()
+            with impute2.Impute2File(f.name, samples=[1]) as i2:
+                probabilities, variants = i2.read_block(10)
+            self.assertTrue(compare_vectors(probabilities, [[[0, 0, 1]]]))
+            with impute2.Impute2File(f.name, samples=[]) as i2:
+                self.assertEqual(next(i2).probabilities.shape, (0, 3))
+
+        with impute2.Impute2File(self.f.name, samples=[3]) as f:
+            self.assertRaises(ValueError, next, f)
+            self.assertRaises(ValueError, f.read_block)
+
+    def test_hard_call_codes(self):
+        """Test the hard calls as integer codes (and packed codes)."""
+        expected = [[0, 0, 1], [0, 0, 2], [0, 1, 2]]
+        expected_9 = [[0, 0, 1], [-1, 0, 2], [-1, 1, 2]]
+
+        for kwargs, calls in (({}, expected),
+                              ({"prob_threshold": 0.9}, expected_9)):
+            with impute2.Impute2File(self.f.name, "hard_call", codes=True,
+                                     **kwargs) as f:
+                results = list(f)
+            self.assertEqual([list(r[0]) for r in results], calls)
+            self.assertEqual(results[0][0].dtype, np.int8)
+            self.assertEqual(results[2][1], {"name": "rs23457", "chrom": "1",
+                                             "pos": 3214570, "a1": "T",
+                                             "a2": "TC"})
+
+            with impute2.Impute2File(self.f.name, "hard_call", packed=True,
+                                     processes=2, **kwargs) as f:
+                results = list(f)
+            self.assertEqual([r[0].shape for r in results], [(1, )] * 3)
+            self.assertEqual(
+                [list(impute2.unpack_hard_calls(r[0], 3)) for r in results],
+                calls,
+            )
+
+        # A genotype is called if a probability is larger than the threshold
+        # (as for the dosage).
+        with impute2.Impute2File(self.f.name, "hard_call", codes=True,
+                                 prob_threshold=0.988) as f:
+            self.assertEqual(list(next(f)[0]), [0, -1, 1])
+        with impute2.Impute2File(self.f.name, "dosage",
+                                 prob_threshold=0.988) as f:
+            self.assertTrue(np.isnan(next(f)[0][1]))
+
+        # Packing over the last axis.
+        calls = np.array([[0, 1, 2, -1, 2], [2, 2, -1, 0, 1]], dtype=np.int8)
+        packed = impute2.pack_hard_calls(calls)
+        self.assertEqual(packed.shape, (2, 2))
+        self.assertEqual(list(packed[0]), [0b11100100, 0b10])
+        self.assertTrue(
+            (impute2.unpack_hard_calls(packed, 5) == calls).all()
+        )
+
+    def test_variant_stats(self):
+        """Test the summary statistics of the variants."""
+        with impute2.Impute2File(self.f.name, block_size=2) as f:
+            stats = f.variant_stats()
+
+        self.assertEqual(list(stats.columns),
+                         ["name", "chrom", "pos", "a1", "a2", "minor", "maf",
+                          "mac", "missing", "hwe_p", "info"])
+        self.assertEqual(list(stats.name), ["rs12345", "rs23456", "rs23457"])
+        self.assertEqual(list(stats.minor), ["G", "T", "T"])
+        self.assertTrue(compare_vectors(
+            stats.maf, [1.005 / 6, 1 - 2.099 / 4, 1 - 3 / 4],
+        ))
+        self.assertTrue(compare_vectors(stats.mac, [1.005, 1.901, 1]))
+        self.assertTrue(compare_vectors(stats.missing, [0, 1 / 3, 1 / 3]))
+
+        # Genotype counts of (2, 1, 0), (1, 0, 1) and (0, 1, 1).
+        self.assertTrue(compare_vectors(
+            stats.hwe_p, [math.erfc(math.sqrt(3 / 25 / 2)),
+                          math.erfc(math.sqrt(2 / 2)),
+                          math.erfc(math.sqrt(2 / 9 / 2))],
+        ))
+
+        with impute2.Impute2File(self.f.name) as f:
+            probabilities, variants = f.read_block()
+        self.assertTrue(compare_vectors(stats["info"],
+                                        impute2._info_score(probabilities)))
+
+        # In parallel (and written to a file).
+        with tempfile.NamedTemporaryFile("r") as out:
+            with impute2.Impute2File(self.f.name, processes=2,
+                                     block_size=1) as f:
+                parallel_stats = f.variant_stats(out_fn=out.name)
+            written = out.read().splitlines()
+
+        self.assertEqual(len(written), 4)
+        self.assertEqual(written[0].split("\t"), list(stats.columns))
+        self.assertEqual(written[2].split("\t")[:6],
+                         ["rs23456", "1", "3214569", "T", "C", "T"])
+        for column in ("maf", "mac", "missing", "hwe_p", "info"):
+            self.assertTrue(compare_vectors(parallel_stats[column],
+                                            stats[column]))
+
+    def test_sample_qc(self):
+        """Test the per sample QC accumulators."""
+        with impute2.Impute2File(self.f.name) as f:
+            qc = f.sample_qc()
+        self.assertEqual(qc.n_variants, 3)
+
+        df = qc.result()
+        self.assertEqual(list(df.n_called), [1, 3, 3])
+        self.assertTrue(compare_vectors(df.call_rate, [1 / 3, 1, 1]))
+        self.assertTrue(compare_vectors(df.het_rate, [0, 1 / 3, 1 / 3]))
+        self.assertTrue(compare_vectors(df.mean_dosage,
+                                        [0, 1.101 / 3, 5.003 / 3]))
+
+        # The expected homozygosity of the variants is 7 / 12, 0 and 1 / 4.
+        f_value = (2 - 5 / 6) / (3 - 5 / 6)
+        self.assertTrue(compare_vectors(df.f, [1, f_value, f_value]))
+
+        # Merging the accumulators of the blocks (and in parallel).
+        merged = impute2.SampleQC(3)
+        with impute2.Impute2File(self.f.name) as f:
+            for probabilities, variants in f.iter_blocks(1):
+                block_qc = impute2.SampleQC(3)
+                block_qc.update(probabilities, variants)
+                merged.merge(block_qc)
+
+        with impute2.Impute2File(self.f.name, processes=2,
+                                 block_size=1) as f:
+            parallel = f.sample_qc().result()
+
+        for result in (merged.result(), parallel):
+            for column in df.columns:
+                self.assertTrue(compare_vectors(result[column], df[column]))
+
+        # The variants of the inbreeding coefficient.
+        with impute2.Impute2File(self.f.name, samples=[2, 0, 1]) as f:
+            df = f.sample_qc(f_variants={"rs23456"}).result()
+        self.assertEqual(list(df.n_called), [3, 1, 3])
+        self.assertEqual(list(df.f[[0, 2]]), [1, 1])
+        self.assertTrue(np.isnan(df.f[1]))
+
+        self.assertRaises(ValueError, merged.merge, impute2.SampleQC(2))
+
+    def test_dosage_filters(self):
+        """Test the variant filters of the dosage mode."""
+        expected = {"rs12345": self.dosage_snp1, "rs23456": self.dosage_snp2,
+                    "rs23457": self.dosage_indel}
+
+        for filters, names in (
+            ({"min_maf": 0.2}, ["rs23456", "rs23457"]),
+            ({"min_info": 0.9}, ["rs12345", "rs23457"]),
+            ({"min_maf": 0.2, "min_info": 0.9}, ["rs23457"]),
+            ({"min_maf": 0.2, "min_info": None}, ["rs23456", "rs23457"]),
+            ({"min_maf": 0.5}, []),
+        ):
+            for processes in (1, 2):
+                with impute2.Impute2File(self.f.name, "dosage",
+                                         processes=processes, block_size=2,
+                                         **filters) as f:
+                    results = list(f)
+
+                self.assertEqual([info["name"] for _, info in results],
+                                 names)
+                for result in results:
+                    self.assertTrue(compare_dosages(
+                        self, expected[result[1]["name"]], result,
+                    ))
+
+        # The missing genotypes (with a probability threshold).
+        with impute2.Impute2File(self.f.name, "dosage", prob_threshold=0.9,
+                                 max_missing=0.1) as f:
+            self.assertEqual([info["name"] for _, info in f], ["rs12345"])
+            m, df = f.as_matrix()
+        self.assertEqual(m.shape, (3, 1))
+        self.assertEqual(list(df.name), ["rs12345"])
+
+        with impute2.Impute2File(self.f.name, "dosage", prob_threshold=0.9,
+                                 max_missing=0.4) as f:
+            self.assertEqual(len(list(f)), 3)
+
+        # The variants with exactly the maximal proportion of missing
+        # genotypes pass the filter (one missing genotype out of three).
+        with impute2.Impute2File(self.f.name, "dosage", prob_threshold=0.9,
+                                 max_missing=1 / 3.0) as f:
+            self.assertEqual(len(list(f)), 3)
+
+        # The filters are applied to the dosage stores.
+        tmp_dir = tempfile.mkdtemp()
+        prefix = os.path.join(tmp_dir, "store")
+        try:
+            with impute2.Impute2File(self.f.name, "dosage",
+                                     min_maf=0.2) as f:
+                expected_m, _ = f.as_matrix()
+                for layout in ("sample", "variant"):
+                    store = f.to_dosage_store(prefix, layout=layout,
+                                              block_size=1)
+                    self.assertEqual(list(store.variants.name),
+                                     ["rs23456", "rs23457"])
+                    self.assertTrue(compare_vectors(store.dosage(),
+                                                    expected_m))
+                    del store
+        finally:
+            for ext in (".dosage", ".json", ".variants.txt"):
+                os.remove(prefix + ext)
+            os.rmdir(tmp_dir)
+
+        # The info score.
+        self.assertTrue(compare_vectors(impute2._info_score(np.array([
+            [[1, 0, 0], [0, 1, 0], [0, 0, 1]],
+            [[0.25, 0.5, 0.25]] * 3,
+            [[1, 0, 0]] * 3,
+        ])), [1, 0, 1]))
+
+    def test_query(self):
+        """Test the random access to regions (using an index)."""
+        with tempfile.NamedTemporaryFile("w") as f:
+            with open(self.f.name) as f1:
+                f.write(f1.read() + "\n")
+            f.write("2 rs34567 1000 A G 0 1 0 0 0 1 1 0 0\n")
+            f.flush()
+
+            try:
+                with impute2.Impute2File(f.name) as i2:
+                    lines = list(i2.query(1, 3214569, 3214570))
+                    self.assertEqual(len(lines), 2)
+                    self.assertTrue(compare_lines(lines[0], self.prob_snp2))
+                    self.assertTrue(compare_lines(lines[1], self.prob_indel))
+                    self.assertEqual(i2.get("2", 999), [])
+                    self.assertEqual(i2.get("3", 1000), [])
+                    self.assertEqual(i2.get("2", 1000)[0].name, "rs34567")
+
+                    # The iteration still starts at the beginning.
+                    self.assertTrue(compare_lines(next(i2), self.prob_snp1))
+
+                self.assertTrue(os.path.isfile(f.name + ".gtidx"))
+
+                with impute2.Impute2File(f.name, "dosage") as i2:
+                    results = i2.get(1, 1231415)
+                    self.assertEqual(len(results), 1)
+                    self.assertTrue(compare_dosages(self, self.dosage_snp1,
+                                                    results[0]))
+
+                with impute2.Impute2File(f.name, "hard_call") as i2:
+                    results = list(i2.query("1", 3214000, 3214569))
+                    self.assertEqual(len(results), 1)
+                    self.assertTrue(compare_dosages(self, self.hard_call_snp2,
+                                                    results[0]))
+            finally:
+                os.remove(f.name + ".gtidx")
+
+
+class TestBinaryImpute2(unittest.TestCase):
+    """Tests the binary IMPUTE2 format (compared to the text files)."""
+
+    def setUp(self):
+        self.f = tempfile.NamedTemporaryFile("w", suffix=".impute2")
+        rng = np.random.RandomState(42)
+        for i in range(25):
+            probabilities = rng.dirichlet([1, 1, 1], 7).round(3)
+            probabilities[:, 2] = 1 - probabilities[:, :2].sum(axis=1)
+            probabilities[i % 7] = 0
+            self.f.write("{} rs{} {} A G {}\n".format(
+                1 + i // 20, i, 1000 * (i + 1),
+                " ".join("{:.3f}".format(p) for p in probabilities.ravel()),
+            ))
+        self.f.flush()
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmp_dir, "test.gtpb")
+
+    def tearDown(self):
+        self.f.close()
+        if os.path.isfile(self.fn):
+            os.remove(self.fn)
+        os.rmdir(self.tmp_dir)
+
+    def test_line(self):
+        """Test the probabilities (with 8 and 16 bits)."""
+        with impute2.Impute2File(self.f.name) as f:
+            expected = list(f)
+
+        for bits in (8, 16):
+            impute2_binary.convert_impute2(self.f.name, self.fn, bits=bits,
+                                           block_size=10)
+            with impute2_binary.BinaryImpute2File(self.fn) as f:
+                self.assertEqual((f.n_samples, f.n_variants), (7, 25))
+                self.assertEqual(list(f.variants.name),
+                                 [line.name for line in expected])
+                results = list(f)
+
+            self.assertEqual(len(results), 25)
+            for result, line in zip(results, expected):
+                self.assertEqual(result[:5], line[:5])
+                error = np.abs(result.probabilities - line.probabilities)
+                self.assertTrue(error.max() <= 0.5 / (2 ** bits - 1))
+                self.assertTrue(
+                    (result.probabilities.sum(axis=1) == 0).any()
+                )
+
+    def test_modes(self):
+        """Test the dosage and hard call modes."""
+        impute2_binary.convert_impute2(self.f.name, self.fn, bits=16,
+                                       block_size=10)
+
+        for mode, kwargs in (("dosage", {}),
+                             ("dosage", {"prob_threshold": 0.5}),
+                             ("dosage", {"min_maf": 0.3}),
+                             ("hard_call", {"prob_threshold": 0.5}),
+                             ("hard_call", {"codes": True})):
+            with impute2.Impute2File(self.f.name, mode, **kwargs) as f:
+                expected = list(f)
+            with impute2_binary.BinaryImpute2File(self.fn, mode,
+                                                  **kwargs) as f:
+                results = list(f)
+
+            self.assertEqual(len(results), len(expected))
+            for result, line in zip(results, expected):
+                self.assertEqual(result[1]["name"], line[1]["name"])
+                if result[0].dtype.kind == "f":
+                    self.assertTrue(np.allclose(result[0], line[0],
+                                                atol=1e-4, equal_nan=True))
+                else:
+                    self.assertTrue((result[0] == line[0]).all())
+
+        with impute2.Impute2File(self.f.name, samples=[1, 3]) as f:
+            expected, expected_df = f.as_matrix()
+        with impute2_binary.BinaryImpute2File(self.fn, samples=[1, 3]) as f:
+            m, df = f.as_matrix()
+        self.assertEqual(m.shape, (2, 25))
+        self.assertTrue(np.allclose(m, expected, atol=1e-4))
+        self.assertEqual(list(df.name), list(expected_df.name))
+        self.assertEqual(list(df.minor), list(expected_df.minor))
+
+        with impute2.Impute2File(self.f.name) as f:
+            expected = f.variant_stats(prob_threshold=0.5)
+        with impute2_binary.BinaryImpute2File(self.fn) as f:
+            stats = f.variant_stats(prob_threshold=0.5)
+        self.assertEqual(list(stats.name), list(expected.name))
+        for column in ("maf", "mac", "missing", "hwe_p", "info"):
+            self.assertTrue(np.allclose(stats[column], expected[column],
+                                        atol=1e-3))
+
+        with impute2.Impute2File(self.f.name) as f:
+            expected = f.sample_qc(prob_threshold=0.5).result()
+        with impute2_binary.BinaryImpute2File(self.fn) as f:
+            result = f.sample_qc(prob_threshold=0.5).result()
+        for column in expected.columns:
+            self.assertTrue(np.allclose(result[column], expected[column],
+                                        atol=1e-3))
+
+        self.assertRaises(TypeError, impute2_binary.BinaryImpute2File,
+                          self.fn, min_maf=0.1)
+        self.assertRaises(ValueError, impute2_binary.BinaryImpute2File,
+                          self.f.name)
+
+    def test_query(self):
+        """Test the random access to regions."""
+        impute2_binary.convert_impute2(self.f.name, self.fn, block_size=4)
+
+        with impute2_binary.BinaryImpute2File(self.fn, "dosage") as f:
+            self.assertEqual(next(f)[1]["name"], "rs0")
+
+            results = list(f.query(1, 7000, 10000))
+            self.assertEqual([info["name"] for _, info in results],
+                             ["rs6", "rs7", "rs8", "rs9"])
+            self.assertEqual(len(f.get("chr2", 21000)), 1)
+            self.assertEqual(f.get("2", 1000), [])
+            self.assertEqual(f.get("3", 21000), [])
+
+            # The iteration continues where it was.
+            self.assertEqual(next(f)[1]["name"], "rs1")
+
+            # The blocks are found from the table of their regions.
+            self.assertTrue(f._variants is None)
+
+    def test_blocks(self):
+        """Test the blocks of variants (as for Impute2File)."""
+        impute2_binary.convert_impute2(self.f.name, self.fn, block_size=4)
+
+        with impute2.Impute2File(self.f.name) as f:
+            expected = list(f.iter_blocks(7))
+
+        with impute2_binary.BinaryImpute2File(self.fn) as f:
+            self.assertEqual(len(f.read_stored_block(6)[1]), 1)
+            self.assertEqual(len(list(f.iter_stored_blocks())), 7)
+
+            blocks = list(f.iter_blocks(7))
+            self.assertEqual(f.read_block()[0].shape, (0, 7, 3))
+
+        self.assertEqual([len(v) for _, v in blocks], [7, 7, 7, 4])
+        for (probabilities, variants), (expected_p, expected_v) in \
+                zip(blocks, expected):
+            self.assertEqual(variants.tolist(), expected_v.tolist())
+            self.assertTrue(np.allclose(probabilities, expected_p,
+                                        atol=0.5 / 255))
+
+        # The blocks and the iteration share the same position.
+        with impute2_binary.BinaryImpute2File(self.fn) as f:
+            self.assertEqual(list(f.read_block(5)[1].name),
+                             ["rs0", "rs1", "rs2", "rs3", "rs4"])
+            self.assertEqual(next(f).name, "rs5")
+
+    def test_chr_prefix(self):
+        """Test a file with "chr" prefixed chromosomes."""
+        fn = os.path.join(self.tmp_dir, "chr.impute2")
+        with open(self.f.name, "r") as f_in, open(fn, "w") as f_out:
+            for line in f_in:
+                f_out.write("chr" + line)
+
+        try:
+            impute2_binary.convert_impute2(fn, self.fn, block_size=4)
+            with impute2_binary.BinaryImpute2File(self.fn, processes=2,
+                                                  block_size=10) as f:
+                self.assertEqual(next(f).chrom, "chr1")
+                for chrom in ("chr1", "1", 1):
+                    self.assertEqual(
+                        [line.name for line in f.query(chrom, 7000, 10000)],
+                        ["rs6", "rs7", "rs8", "rs9"]
+                    )
+                self.assertEqual(f.get("2", 21000)[0].chrom, "chr2")
+
+        finally:
+            os.remove(fn)
+
 
 class TestGTF(unittest.TestCase):
     """Test the GTF file parser."""
@@ -462,3 +1072,81 @@ class TestGFF(TestGTF):
     """Test the GFF binding."""
     def setUp(self):
         self.cls = fmts.gff.GFFFile
+
+
+class TestBgzf(unittest.TestCase):
+    """Test the BGZF reader."""
+    def setUp(self):
+        self.f = tempfile.NamedTemporaryFile("w", delete=False)
+        self.lines = ["line number {}\n".format(i) for i in range(200)]
+        self.f.write("".join(self.lines))
+        self.f.close()
+
+        # Small blocks so that lines overlap blocks.
+        self.fn = fmts.bgzf.compress(self.f.name, block_size=100)
+
+    def tearDown(self):
+        os.remove(self.f.name)
+        os.remove(self.fn)
+
+    def test_read(self):
+        self.assertTrue(fmts.bgzf.is_bgzf(self.fn))
+        self.assertFalse(fmts.bgzf.is_bgzf(self.f.name))
+
+        with fmts.bgzf.BgzfFile(self.fn) as f:
+            self.assertEqual(list(f), self.lines)
+
+        # The file should also be readable using the gzip module.
+        with gzip.open(self.fn, "rb") as f:
+            self.assertEqual(f.read().decode("utf-8"), "".join(self.lines))
+
+    def test_seek(self):
+        with fmts.bgzf.BgzfFile(self.fn) as f:
+            offsets = []
+            for i in range(len(self.lines)):
+                offsets.append(f.tell())
+                f.readline()
+
+            # The virtual offsets are increasing.
+            self.assertEqual(offsets, sorted(offsets))
+
+            for i in (150, 3, 199, 0, 42):
+                f.seek(offsets[i])
+                self.assertEqual(f.readline(), self.lines[i])
+
+            # Seeking to a position in the compressed file.
+            f.seek_block(os.path.getsize(self.fn) // 2)
+            block_offset, within = fmts.bgzf.split_virtual_offset(f.tell())
+            self.assertEqual(within, 0)
+            self.assertTrue(block_offset >= os.path.getsize(self.fn) // 2)
+
+            f.readline()
+            self.assertTrue(f.readline() in self.lines)
+
+    def test_lazy_first_block(self):
+        with fmts.bgzf.BgzfFile(self.fn) as f:
+            offsets = [f.tell()]
+            for line in self.lines:
+                f.readline()
+                offsets.append(f.tell())
+
+        reads = []
+        with open(self.fn, "rb") as raw:
+            def pread(size, offset):
+                reads.append(offset)
+                raw.seek(offset)
+                return raw.read(size)
+
+            # The first block is not decompressed if it's not read.
+            f = fmts.bgzf.BgzfFile(self.fn, pread=pread)
+            f.seek(offsets[150])
+            self.assertEqual(f.readline(), self.lines[150])
+            self.assertFalse(fmts.bgzf._HEADER.size in reads)
+
+            f.seek(offsets[0])
+            self.assertEqual(f.readline(), self.lines[0])
+            self.assertTrue(fmts.bgzf._HEADER.size in reads)
+
+        with fmts.bgzf.BgzfFile(self.fn) as f:
+            self.assertEqual(f.tell(), 0)
+            self.assertEqual(f.readline(), self.lines[0])